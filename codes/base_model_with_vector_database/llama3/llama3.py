@@ -1,11 +1,11 @@
 from codes.util.llama3_util import load_llama3_model, llama3_ask
-from codes.util.faiss_util import search_docs
+from codes.run.ask_functions import search_rag_docs
 
 # 查詢問題
 query = "審核 API 要用甚麼規則?"
 filter_by_threshold = False
 
-retrieved_docs, filtered_results = search_docs(query=query, threshold=filter_by_threshold)
+retrieved_docs, filtered_results = search_rag_docs(query=query, threshold=filter_by_threshold)
 
 llm_pipeline, tokenizer = load_llama3_model()
 
@@ -1,11 +1,11 @@
 from codes.util.magicoder_util import magicoder_ask, load_magicoder_model
-from codes.util.faiss_util import search_docs
+from codes.run.ask_functions import search_rag_docs
 
 # 查詢問題
 query = "審核 API 要用甚麼規則?"
 filter_by_threshold = False
 
-retrieved_docs, filtered_results = search_docs(query=query, threshold=filter_by_threshold)
+retrieved_docs, filtered_results = search_rag_docs(query=query, threshold=filter_by_threshold)
 
 # 建立提示詞，把檢索到的文件和問題一起丟給生成模型
 prompt = f"根據以下規則回答問題：\n{retrieved_docs}\n\n問題：{query}\n回答："
@@ -0,0 +1,88 @@
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from codes.util.faiss_index_util import INDEX_TYPES, build_faiss_index
+
+CODE_TO_DETECT_DIR = Path(__file__).resolve().parents[2] / "datas" / "code_to_detect"
+
+
+def synthetic_vectors(n: int, dim: int, n_clusters: int = 64, seed: int = 0) -> np.ndarray:
+    # 有群聚結構的單位向量，比均勻亂數更接近真實 embedding 分佈
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    labels = rng.integers(0, n_clusters, size=n)
+    vectors = centers[labels] + 0.5 * rng.standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def real_vectors() -> tuple[np.ndarray, np.ndarray]:
+    # rule_docs 當資料庫，datas/code_to_detect 的檔案當 query
+    from codes.util.faiss_util import get_embeddings
+    from datas.RAG_data.rag_data import rule_docs
+
+    queries = [
+        f.read_text(encoding="utf-8")
+        for f in sorted(CODE_TO_DETECT_DIR.rglob("*"))
+        if f.is_file()
+    ]
+    return get_embeddings(rule_docs), get_embeddings(queries)
+
+
+def latency_percentiles(index, queries: np.ndarray, k: int) -> tuple[float, float]:
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        index.search(q.reshape(1, -1), k)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 99))
+
+
+def recall_at_k(exact_ids: np.ndarray, approx_ids: np.ndarray) -> float:
+    hits = sum(
+        len(set(e[e != -1].tolist()) & set(a[a != -1].tolist()))
+        for e, a in zip(exact_ids, approx_ids)
+    )
+    return hits / max(1, int((exact_ids != -1).sum()))
+
+
+def run_benchmark(name: str, database: np.ndarray, queries: np.ndarray, k: int) -> None:
+    print(f"\n=== {name}: {database.shape[0]} docs, {queries.shape[0]} queries, dim {database.shape[1]} ===")
+    print(f"{'index':<10}{'build s':>10}{'recall@' + str(k):>12}{'p50 ms':>10}{'p99 ms':>10}")
+
+    k = min(k, database.shape[0])
+    exact_ids = None
+    for index_type in INDEX_TYPES:
+        start = time.perf_counter()
+        index = build_faiss_index(database, index_type=index_type)
+        build_seconds = time.perf_counter() - start
+
+        _, ids = index.search(queries, k)
+        if exact_ids is None:
+            exact_ids = ids
+        p50, p99 = latency_percentiles(index, queries, k)
+        print(f"{index_type:<10}{build_seconds:>10.2f}{recall_at_k(exact_ids, ids):>12.3f}{p50:>10.3f}{p99:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall / latency of the RAG index types against exact flat search")
+    parser.add_argument("--n", type=int, default=50000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=2560, help="synthetic vector dimension")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--real", action="store_true", help="also benchmark the real rule_docs corpus")
+    args = parser.parse_args()
+
+    # flat 一定排第一，作為計算 recall 的精確基準
+    assert INDEX_TYPES[0] == "flat"
+
+    synthetic = synthetic_vectors(args.n + args.queries, args.dim)
+    run_benchmark("synthetic", synthetic[:args.n], synthetic[args.n:], args.k)
+
+    if args.real:
+        docs, queries = real_vectors()
+        run_benchmark("rule_docs", docs, queries, args.k)
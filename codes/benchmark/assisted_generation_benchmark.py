@@ -0,0 +1,120 @@
+import argparse
+import copy
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import AutoTokenizer, Qwen3Config, Qwen3ForCausalLM
+
+from codes.benchmark.retrieval_benchmark import load_files
+from codes.run.CoT.global_rule import GLOBAL_RULE_PREFIX_MARKERS, build_global_rule_template
+from codes.run.CoT.linter import LINTER_TEMPLATE
+from codes.util.generation_budget import token_usage
+from codes.util.prefix_cache import PrefixCache
+from codes.util.qwen3_util import load_draft_model, load_qwen3_model, qwen3_ask, use_draft_model
+
+
+@contextmanager
+def count_forward_calls(model):
+    # 計算 generate 期間 model 的 forward 次數；PeftModel 要掛在底下真正做 forward 的模型上
+    module = model.get_base_model() if hasattr(model, "get_base_model") else model
+    counter = {"calls": 0}
+    handle = module.register_forward_hook(lambda *_: counter.__setitem__("calls", counter["calls"] + 1))
+    try:
+        yield counter
+    finally:
+        handle.remove()
+
+
+def tiny_models(tokenizer) -> tuple:
+    # CPU 可跑的隨機小模型；draft 共用 target 的 embedding、lm_head 與前半的 layers，兩者的預測才會部分一致
+    config = Qwen3Config(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=4,
+        num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=32768,
+        tie_word_embeddings=True, pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    model = Qwen3ForCausalLM(config).eval()
+    draft_model = copy.deepcopy(model)
+    draft_model.model.layers = draft_model.model.layers[:config.num_hidden_layers // 2]
+    draft_model.config.num_hidden_layers = config.num_hidden_layers // 2
+    for generation_model in (model, draft_model):
+        generation_model.generation_config.do_sample = False
+    # 隨機模型的機率分布接近均勻，預設的 confidence threshold 會讓 draft 每輪只提出一個 token
+    draft_model.generation_config.assistant_confidence_threshold = 0.0
+    return model, draft_model
+
+
+def run(prompts: list[str], model, tokenizer, max_new_tokens: int, draft_model=None) -> dict:
+    # 與 pipeline 相同經過 qwen3_ask（含 thinking 預算、停止條件與重複偵測），只差在有沒有註冊 draft model
+    stage = "assisted" if draft_model is not None else "baseline"
+    target_calls = draft_calls = 0
+    use_draft_model(model, draft_model)
+    start = time.perf_counter()
+    try:
+        for prompt in prompts:
+            with count_forward_calls(model) as target, \
+                    count_forward_calls(draft_model if draft_model is not None else model) as draft:
+                qwen3_ask(prompt, model, tokenizer, max_new_tokens=max_new_tokens, stage=stage)
+            target_calls += target["calls"]
+            draft_calls += draft["calls"] if draft_model is not None else 0
+    finally:
+        use_draft_model(model, None)
+
+    seconds = time.perf_counter() - start
+    generated_tokens = sum(r["thinking_tokens"] + r["answer_tokens"] for r in token_usage[stage])
+    result = {"tokens": generated_tokens, "tokens_per_second": generated_tokens / seconds,
+              "tokens_per_target_step": generated_tokens / max(1, target_calls)}
+    if draft_model is not None:
+        # 每次主模型驗證都會多產生一個自己的 token，其餘的才是被接受的 draft token
+        result["acceptance_rate"] = (generated_tokens - target_calls) / max(1, draft_calls)
+    return result
+
+
+def check_equivalence(prompts: list[str], model, tokenizer, max_new_tokens: int, draft_model) -> list[bool]:
+    # greedy 下，註冊 draft model 並帶著 prefix cache（cot.py 的用法）的輸出必須與一般 qwen3_ask 完全相同
+    prompts = [build_global_rule_template(prompt=prompt) for prompt in prompts]
+    expected = [qwen3_ask(p, model, tokenizer, max_new_tokens=max_new_tokens, stage="equivalence") for p in prompts]
+    prefix_cache = PrefixCache(model, tokenizer, markers=GLOBAL_RULE_PREFIX_MARKERS)
+    use_draft_model(model, draft_model)
+    try:
+        actual = [qwen3_ask(p, model, tokenizer, max_new_tokens=max_new_tokens, prefix_cache=prefix_cache,
+                            stage="equivalence") for p in prompts]
+    finally:
+        use_draft_model(model, None)
+    return [a == e for a, e in zip(actual, expected)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Acceptance rate and tokens/sec of assisted generation with a draft model")
+    parser.add_argument("--model", default="Qwen/Qwen3-30B-A3B-Thinking-2507")
+    parser.add_argument("--lora", default=None)
+    parser.add_argument("--draft-model", default="Qwen/Qwen3-1.7B")
+    parser.add_argument("--draft-lora", default=None)
+    parser.add_argument("--n-prompts", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--tiny", action="store_true",
+                        help="random tiny target/draft models with the --draft-model tokenizer, runs on CPU")
+    args = parser.parse_args()
+
+    if args.tiny:
+        tokenizer = AutoTokenizer.from_pretrained(args.draft_model)
+        model, draft_model = tiny_models(tokenizer)
+    else:
+        model, tokenizer = load_qwen3_model(lora_path=args.lora, model_name=args.model)
+        draft_model = load_draft_model(args.draft_model, lora_path=args.draft_lora)
+
+    prompts = [LINTER_TEMPLATE.format(code_diff=code) for code in list(load_files().values())[:args.n_prompts]]
+
+    if args.tiny:
+        matches = check_equivalence(prompts, model, tokenizer, args.max_new_tokens, draft_model)
+        print(f"assisted + prefix cache matches greedy qwen3_ask: {sum(matches)}/{len(matches)}")
+
+    baseline = run(prompts, model, tokenizer, args.max_new_tokens)
+    assisted = run(prompts, model, tokenizer, args.max_new_tokens, draft_model=draft_model)
+
+    print(f"\n=== {len(prompts)} prompts, max_new_tokens {args.max_new_tokens} ===")
+    print(f"{'':<12}{'tokens/s':>10}{'tokens/step':>13}{'acceptance':>12}")
+    print(f"{'baseline':<12}{baseline['tokens_per_second']:>10.1f}{baseline['tokens_per_target_step']:>13.2f}{'-':>12}")
+    print(f"{'assisted':<12}{assisted['tokens_per_second']:>10.1f}{assisted['tokens_per_target_step']:>13.2f}"
+          f"{assisted['acceptance_rate']:>12.1%}  ({assisted['tokens_per_second'] / baseline['tokens_per_second']:.2f}x)")
@@ -0,0 +1,59 @@
+import argparse
+import time
+
+import torch
+
+from codes.benchmark.retrieval_benchmark import load_files
+from codes.run.CoT.linter import LINTER_TEMPLATE
+from codes.util.continuous_batching import ContinuousBatchingEngine
+from codes.util.qwen3_util import load_qwen3_model
+
+
+@torch.no_grad()
+def sequential_tokens_per_second(prompts: list[str], budgets: list[int], model, tokenizer) -> float:
+    # 與 qwen3_ask 相同的逐筆 generate 迴圈，另外記錄實際產生的 token 數
+    generated_tokens = 0
+    start = time.perf_counter()
+    for prompt, max_new_tokens in zip(prompts, budgets):
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+        generated_ids = model.generate(**model_inputs, max_new_tokens=max_new_tokens)
+        generated_tokens += generated_ids.shape[1] - model_inputs.input_ids.shape[1]
+    return generated_tokens / (time.perf_counter() - start)
+
+
+def continuous_tokens_per_second(prompts: list[str], budgets: list[int], model, tokenizer, max_batch_size: int) -> float:
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=max_batch_size)
+    for prompt, max_new_tokens in zip(prompts, budgets):
+        engine.submit(prompt, max_new_tokens=max_new_tokens)
+    for _ in engine.run():
+        pass
+    return engine.tokens_per_second()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate tokens/sec: sequential qwen3_ask loop vs continuous batching")
+    parser.add_argument("--model", default="Qwen/Qwen3-1.7B")
+    parser.add_argument("--lora", default=None)
+    parser.add_argument("--n-prompts", type=int, default=16)
+    parser.add_argument("--max-new-tokens", type=int, default=512,
+                        help="budget of the longest request; the others get shorter, mixed budgets")
+    parser.add_argument("--max-batch", type=int, default=8)
+    args = parser.parse_args()
+
+    model, tokenizer = load_qwen3_model(lora_path=args.lora, model_name=args.model)
+
+    codes = list(load_files().values())[:args.n_prompts]
+    prompts = [LINTER_TEMPLATE.format(code_diff=code) for code in codes]
+    # 長短混合的 max_new_tokens，模擬 stage 之間差異很大的生成長度
+    budgets = [max(16, args.max_new_tokens // (1 + i % 4)) for i in range(len(prompts))]
+
+    sequential = sequential_tokens_per_second(prompts, budgets, model, tokenizer)
+    continuous = continuous_tokens_per_second(prompts, budgets, model, tokenizer, args.max_batch)
+    print(f"\n=== {len(prompts)} requests, max_new_tokens up to {args.max_new_tokens} ===")
+    print(f"{'sequential qwen3_ask':<28}{sequential:>10.1f} tokens/s")
+    print(f"{'continuous batching':<28}{continuous:>10.1f} tokens/s  ({continuous / sequential:.2f}x)")
@@ -0,0 +1,64 @@
+import argparse
+import gc
+import time
+
+import numpy as np
+import torch
+
+from codes.benchmark.ann_index_benchmark import CODE_TO_DETECT_DIR
+from codes.benchmark.quantization_benchmark import top_k_overlap
+from codes.util import faiss_util
+from codes.util.faiss_index_util import build_faiss_index
+from datas.RAG_data.rag_data import rule_docs
+
+
+def model_nbytes(model) -> int:
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def embed_corpus(queries: list[str]) -> tuple[float, np.ndarray, np.ndarray]:
+    start = time.perf_counter()
+    docs_emb = faiss_util.get_embeddings(rule_docs)
+    queries_emb = faiss_util.get_embeddings(queries)
+    return time.perf_counter() - start, docs_emb, queries_emb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory saved / retrieval overlap of generation-model hidden states vs the dedicated embedder"
+    )
+    parser.add_argument("--model", default="Qwen/Qwen3-30B-A3B-Thinking-2507", help="generation model to reuse")
+    parser.add_argument("--lora", default=None, help="LoRA path (adapters are disabled while embedding)")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    from codes.util.qwen3_util import load_qwen3_model
+
+    queries = [f.read_text(encoding="utf-8") for f in sorted(CODE_TO_DETECT_DIR.rglob("*")) if f.is_file()]
+    k = min(args.k, len(rule_docs))
+
+    # 1. 獨立的 Qwen3-Embedding-4B
+    _, dedicated_model = faiss_util.load_embedding_model()
+    dedicated_bytes = model_nbytes(dedicated_model)
+    dedicated_seconds, docs_emb, queries_emb = embed_corpus(queries)
+    dedicated_dim = docs_emb.shape[1]
+    _, dedicated_ids = build_faiss_index(docs_emb, index_type="flat").search(queries_emb, k)
+
+    # 釋放 embedding model，之後只留生成模型
+    faiss_util.emb_tokenizer = faiss_util.emb_model = dedicated_model = None
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    # 2. 生成模型的 hidden states（base 權重）
+    model, tokenizer = load_qwen3_model(lora_path=args.lora, model_name=args.model)
+    faiss_util.use_generation_model_embeddings(model, tokenizer)
+    generation_seconds, docs_emb, queries_emb = embed_corpus(queries)
+    _, generation_ids = build_faiss_index(docs_emb, index_type="flat").search(queries_emb, k)
+
+    print(f"\n=== {len(rule_docs)} rules, {len(queries)} queries ===")
+    print(f"{'embedder':<12}{'dim':>8}{'embed s':>10}{'overlap@' + str(k):>12}")
+    print(f"{'dedicated':<12}{dedicated_dim:>8}{dedicated_seconds:>10.2f}{1.0:>12.3f}")
+    print(f"{'generation':<12}{docs_emb.shape[1]:>8}{generation_seconds:>10.2f}"
+          f"{top_k_overlap(dedicated_ids, generation_ids):>12.3f}")
+    print(f"Memory saved by not loading {faiss_util.MODEL_NAME}: {dedicated_bytes / 1024 ** 3:.2f} GiB")
@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+
+from codes.benchmark.retrieval_benchmark import load_files
+from codes.run.CoT.code_smell_detector import CODE_SMELL_DETECTOR_TEMPLATE
+from codes.run.CoT.first_code_review import FIRST_CODE_REVIEW_TEMPLATE
+from codes.run.CoT.first_summary_prompt import FIRST_SUMMARY_TEMPLATE
+from codes.run.CoT.global_rule import GLOBAL_RULE_PREFIX_MARKERS, build_global_rule_template
+from codes.run.CoT.linter import LINTER_TEMPLATE
+from codes.run.CoT.total_summary import TOTAL_SUMMARY_TEMPLATE
+from codes.run.ask_functions import get_rag_docs_batch
+from codes.util.prefix_cache import PrefixCache, prefill_seconds
+from codes.util.qwen3_util import build_chat_text, load_qwen3_model
+
+STAGE_TEMPLATES = {
+    "first_summary": FIRST_SUMMARY_TEMPLATE,
+    "first_code_review": FIRST_CODE_REVIEW_TEMPLATE,
+    "linter": LINTER_TEMPLATE,
+    "code_smell": CODE_SMELL_DETECTOR_TEMPLATE,
+}
+
+
+def stage_prompt(stage: str, code: str) -> str:
+    if stage == "total_summary":
+        # 前面 stage 的結果用固定長度的佔位文字，只影響 prompt 後段，不影響共用 prefix
+        placeholder = "(previous stage result)\n" * 20
+        return TOTAL_SUMMARY_TEMPLATE.format(
+            first_code_review=placeholder,
+            first_summary=placeholder,
+            linter_result=placeholder,
+            code_smell_result=placeholder,
+            code_diff=code,
+        )
+    return STAGE_TEMPLATES[stage].format(code_diff=code)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prefill time saved per CoT stage by the shared-prefix KV cache")
+    parser.add_argument("--model", default="Qwen/Qwen3-1.7B")
+    parser.add_argument("--lora", default=None)
+    parser.add_argument("--n-files", type=int, default=8)
+    args = parser.parse_args()
+
+    model, tokenizer = load_qwen3_model(lora_path=args.lora, model_name=args.model)
+    prefix_cache = PrefixCache(model, tokenizer, markers=GLOBAL_RULE_PREFIX_MARKERS)
+
+    codes = list(load_files().values())[:args.n_files]
+    rag_docs_list = get_rag_docs_batch(codes, threshold=0.7, language="python", per_hunk=True)
+
+    timings = {stage: {"full": [], "cached": [], "reused": []} for stage in [*STAGE_TEMPLATES, "total_summary"]}
+    for code, rag_docs in zip(codes, rag_docs_list):
+        for stage, stage_timings in timings.items():
+            text = build_chat_text(build_global_rule_template(rag_rules=rag_docs, prompt=stage_prompt(stage, code)),
+                                   tokenizer)
+            input_ids = tokenizer(text)["input_ids"]
+            stage_timings["full"].append(prefill_seconds(model, input_ids))
+
+            # lookup 第一次遇到某個 prefix 時會先 prefill 它，這個成本也算進 cached
+            start = time.perf_counter()
+            input_ids, prefix_length, cache = prefix_cache.lookup(text, label=stage)
+            lookup_seconds = time.perf_counter() - start
+            stage_timings["cached"].append(lookup_seconds + prefill_seconds(model, input_ids, prefix_length, cache))
+            stage_timings["reused"].append(prefix_length / len(input_ids))
+
+    print(f"\n=== {len(codes)} files ===")
+    print(f"{'stage':<20}{'full ms':>10}{'cached ms':>12}{'saved ms':>10}{'reused':>9}")
+    for stage, stage_timings in timings.items():
+        full = np.mean(stage_timings["full"]) * 1000
+        cached = np.mean(stage_timings["cached"]) * 1000
+        print(f"{stage:<20}{full:>10.1f}{cached:>12.1f}{full - cached:>10.1f}{np.mean(stage_timings['reused']):>9.1%}")
@@ -0,0 +1,61 @@
+import argparse
+
+import numpy as np
+
+from codes.benchmark.ann_index_benchmark import latency_percentiles, real_vectors, synthetic_vectors
+from codes.util.faiss_index_util import build_faiss_index, index_nbytes, truncate_embeddings
+
+TRUNCATED_DIMS = (1024, 512, 256, 128)
+
+
+def variants(full_dim: int) -> list[tuple[str, str, int | None]]:
+    # (名稱, index 類型, 截斷維度)；第一個是 float32 全維度基準
+    result = [("float32 full", "flat", None)]
+    result += [(f"float32 dim={d}", "flat", d) for d in TRUNCATED_DIMS if d < full_dim]
+    result += [("int8 full", "sq8", None), ("binary full", "binary", None)]
+    result += [(f"binary dim={d}", "binary", d) for d in TRUNCATED_DIMS[:1] if d < full_dim]
+    return result
+
+
+def top_k_overlap(reference_ids: np.ndarray, ids: np.ndarray) -> float:
+    k = reference_ids.shape[1]
+    overlap = [len(set(r.tolist()) & set(i.tolist())) / k for r, i in zip(reference_ids, ids)]
+    return float(np.mean(overlap))
+
+
+def run_benchmark(name: str, database: np.ndarray, queries: np.ndarray, k: int) -> None:
+    print(f"\n=== {name}: {database.shape[0]} docs, {queries.shape[0]} queries, dim {database.shape[1]} ===")
+    print(f"{'variant':<18}{'memory MiB':>12}{'overlap@' + str(k):>12}{'p50 ms':>10}{'p99 ms':>10}")
+
+    k = min(k, database.shape[0])
+    reference_ids = None
+    for variant_name, index_type, dim in variants(database.shape[1]):
+        index = build_faiss_index(truncate_embeddings(database, dim), index_type=index_type)
+        variant_queries = truncate_embeddings(queries, dim)
+
+        _, ids = index.search(variant_queries, k)
+        if reference_ids is None:
+            reference_ids = ids
+        p50, p99 = latency_percentiles(index, variant_queries, k)
+        memory_mib = index_nbytes(index) / (1024 ** 2)
+        print(f"{variant_name:<18}{memory_mib:>12.2f}{top_k_overlap(reference_ids, ids):>12.3f}{p50:>10.3f}{p99:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory / latency / top-k overlap of truncated and quantised embeddings vs full float32"
+    )
+    parser.add_argument("--n", type=int, default=50000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=2560, help="synthetic vector dimension")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--real", action="store_true", help="also benchmark the real rule_docs corpus")
+    args = parser.parse_args()
+
+    synthetic = synthetic_vectors(args.n + args.queries, args.dim)
+    run_benchmark("synthetic", synthetic[:args.n], synthetic[args.n:], args.k)
+
+    if args.real:
+        # 以完整維度 embed 一次（RAG_EMBEDDING_DIM 不要設定），再在這裡做各種截斷
+        docs, queries = real_vectors()
+        run_benchmark("rule_docs", docs, queries, args.k)
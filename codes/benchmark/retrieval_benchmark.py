@@ -0,0 +1,176 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from codes.benchmark.ann_index_benchmark import CODE_TO_DETECT_DIR
+from codes.util import faiss_util
+from codes.util.rag_cache import text_hash
+
+DATASET_FOLDERS = ("bad_data", "code_diff", "only_code")
+
+
+def load_files() -> dict[str, str]:
+    files = {}
+    for folder in DATASET_FOLDERS:
+        for f in sorted((CODE_TO_DETECT_DIR / folder).rglob("*")):
+            if f.is_file():
+                files[f.relative_to(CODE_TO_DETECT_DIR).as_posix()] = f.read_text(encoding="utf-8")
+    return files
+
+
+def percentiles(timings_ms: list[float]) -> dict:
+    return {
+        "p50_ms": float(np.percentile(timings_ms, 50)),
+        "p99_ms": float(np.percentile(timings_ms, 99)),
+        "mean_ms": float(np.mean(timings_ms)),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def batch_sizes(max_batch: int) -> list[int]:
+    sizes = [1]
+    while sizes[-1] * 2 <= max_batch:
+        sizes.append(sizes[-1] * 2)
+    if sizes[-1] != max_batch:
+        sizes.append(max_batch)
+    return sizes
+
+
+def run_benchmark(args) -> dict:
+    files = load_files()
+    names = list(files)
+    texts = [files[n] for n in names]
+    search_kwargs = dict(k=args.k, threshold=args.threshold, mode=args.mode, language=args.language)
+
+    # 1. Cold start：載入 embedding model（sparse 模式不需要）
+    timings = {}
+    if args.mode != "sparse":
+        _, timings["cold_start_ms"] = timed(faiss_util.load_embedding_model)
+
+    # 2. Index build（預設不讀快取，量的是真正的 embed + 建 index）；sparse 模式只建 BM25
+    if args.mode == "sparse":
+        bm25_index, timings["index_build_ms"] = timed(faiss_util.build_bm25_index)
+        index_settings = {"index_type": "bm25", "n_rules": len(bm25_index.docs)}
+    else:
+        rule_index, timings["index_build_ms"] = timed(
+            faiss_util.build_rule_index, use_cache=args.use_cache, index_type=args.index_type
+        )
+        index_settings = {"index_type": rule_index.index_type, "n_rules": rule_index.ntotal}
+
+    # 3. 每個檔案分開量 embedding 與 search
+    embed_ms, search_ms = [], []
+    if args.mode != "sparse":
+        for text in texts:
+            q_emb, ms = timed(faiss_util.get_embeddings, [text])
+            embed_ms.append(ms)
+            _, ms = timed(rule_index.search_ids, q_emb, args.k, language=args.language)
+            search_ms.append(ms)
+        timings["embed"] = percentiles(embed_ms)
+        timings["search"] = percentiles(search_ms)
+
+    # 4. 不同 batch size 的端到端吞吐量；每輪先清空 memo，量的是實際計算
+    throughput = []
+    for batch_size in batch_sizes(min(args.max_batch, len(texts))):
+        faiss_util.clear_rag_caches()
+        start = time.perf_counter()
+        for i in range(0, len(texts), batch_size):
+            faiss_util.search_docs_hybrid_batch(texts[i:i + batch_size], **search_kwargs)
+        seconds = time.perf_counter() - start
+        throughput.append({"batch_size": batch_size, "qps": len(texts) / seconds})
+        print(f"[bench] batch_size={batch_size:<4} {len(texts) / seconds:8.2f} queries/s")
+
+    # 5. 每個檔案檢索到的 rule，之後拿來比對 churn
+    faiss_util.clear_rag_caches()
+    retrieved = {}
+    for name, (_, results) in zip(names, faiss_util.search_docs_hybrid_batch(texts, **search_kwargs)):
+        retrieved[name] = [
+            {"rule_id": faiss_util.rule_id(text_hash(r["doc"])), "score": r["score"]}
+            for r in results
+        ]
+
+    return {
+        "settings": {
+            **faiss_util.embedding_settings(),
+            **search_kwargs,
+            **index_settings,
+            "n_files": len(texts),
+        },
+        "timings": timings,
+        "throughput": throughput,
+        "retrieved": retrieved,
+    }
+
+
+def compare_reports(baseline: dict, report: dict, tolerance: float) -> list[str]:
+    # 回傳所有超過容許範圍的退步（變慢、吞吐量下降、檢索結果改變）
+    regressions = []
+
+    def check_slower(name: str, old: float, new: float) -> None:
+        change = (new - old) / max(old, 1e-9)
+        print(f"[compare] {name:<24}{old:>12.2f}{new:>12.2f}{change:>+10.1%}")
+        if change > tolerance:
+            regressions.append(f"{name} slower by {change:.1%}")
+
+    old_t, new_t = baseline["timings"], report["timings"]
+    for name in ("cold_start_ms", "index_build_ms"):
+        if name in old_t and name in new_t:
+            check_slower(name, old_t[name], new_t[name])
+    for stage in ("embed", "search"):
+        if stage in old_t and stage in new_t:
+            check_slower(f"{stage} p50_ms", old_t[stage]["p50_ms"], new_t[stage]["p50_ms"])
+            check_slower(f"{stage} p99_ms", old_t[stage]["p99_ms"], new_t[stage]["p99_ms"])
+
+    old_qps = {t["batch_size"]: t["qps"] for t in baseline["throughput"]}
+    for t in report["throughput"]:
+        if t["batch_size"] in old_qps:
+            # 吞吐量用倒數比較：qps 下降等同於時間變長
+            check_slower(f"batch {t['batch_size']} ms/query", 1000 / old_qps[t["batch_size"]], 1000 / t["qps"])
+
+    churned = []
+    jaccards = []
+    for name, results in report["retrieved"].items():
+        old_ids = {r["rule_id"] for r in baseline["retrieved"].get(name, [])}
+        new_ids = {r["rule_id"] for r in results}
+        union = old_ids | new_ids
+        jaccards.append(len(old_ids & new_ids) / len(union) if union else 1.0)
+        if old_ids != new_ids:
+            churned.append(name)
+    print(f"[compare] retrieved-set churn: {len(churned)}/{len(jaccards)} files changed, "
+          f"mean jaccard {np.mean(jaccards):.3f}")
+    for name in churned:
+        regressions.append(f"retrieved rules changed for {name}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency / throughput / stability of get_rag_docs over datas/code_to_detect")
+    parser.add_argument("--output", default="retrieval_report.json", help="where to write the JSON report")
+    parser.add_argument("--compare", default=None, help="previous report to diff against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging")
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--mode", default=faiss_util.RETRIEVAL_MODE, choices=faiss_util.RETRIEVAL_MODES)
+    parser.add_argument("--language", default="python")
+    parser.add_argument("--index-type", default=faiss_util.RAG_INDEX_TYPE)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--use-cache", action="store_true", help="allow a warm start from the on-disk index cache")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"[bench] Report written to {args.output}")
+
+    if args.compare:
+        regressions = compare_reports(json.loads(Path(args.compare).read_text(encoding="utf-8")), report, args.tolerance)
+        for regression in regressions:
+            print(f"[bench] REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
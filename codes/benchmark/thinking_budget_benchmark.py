@@ -0,0 +1,49 @@
+import argparse
+import time
+
+import numpy as np
+
+from codes.benchmark.retrieval_benchmark import load_files
+from codes.run.CoT.linter import LINTER_TEMPLATE
+from codes.util.generation_budget import token_usage
+from codes.util.qwen3_util import load_qwen3_model, qwen3_ask
+
+
+def parse_budget(value: str):
+    return None if value == "none" else int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency vs answer length of qwen3_ask at several thinking budgets")
+    parser.add_argument("--model", default="Qwen/Qwen3-1.7B")
+    parser.add_argument("--lora", default=None)
+    parser.add_argument("--n-prompts", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=8192)
+    parser.add_argument("--budgets", nargs="+", type=parse_budget, default=[None, 4096, 1024, 256],
+                        help="max thinking tokens per run; 'none' means unlimited")
+    args = parser.parse_args()
+
+    model, tokenizer = load_qwen3_model(lora_path=args.lora, model_name=args.model)
+    prompts = [LINTER_TEMPLATE.format(code_diff=code) for code in list(load_files().values())[:args.n_prompts]]
+
+    results = {}
+    for budget in args.budgets:
+        stage = f"budget_{budget}"
+        latencies, answer_chars = [], []
+        for prompt in prompts:
+            start = time.perf_counter()
+            content, _ = qwen3_ask(prompt, model, tokenizer, max_new_tokens=args.max_new_tokens, stage=stage,
+                                   max_thinking_tokens=budget)
+            latencies.append(time.perf_counter() - start)
+            answer_chars.append(len(content))
+        results[budget] = {"latency": latencies, "answer_chars": answer_chars, "usage": token_usage[stage]}
+
+    print(f"\n=== {len(prompts)} prompts, max_new_tokens {args.max_new_tokens} ===")
+    print(f"{'budget':>8}{'latency s':>11}{'thinking':>10}{'answer tok':>12}{'answer chars':>14}{'forced':>8}")
+    for budget, result in results.items():
+        usage = result["usage"]
+        print(f"{str(budget):>8}{np.mean(result['latency']):>11.2f}"
+              f"{np.mean([u['thinking_tokens'] for u in usage]):>10.0f}"
+              f"{np.mean([u['answer_tokens'] for u in usage]):>12.0f}"
+              f"{np.mean(result['answer_chars']):>14.0f}"
+              f"{sum(u['forced_think_end'] for u in usage):>8}")
@@ -1,3 +1,10 @@
+import os
+
+# 每個 stage 注入的 RAG rules 上限（以目標模型的 tokenizer 計算）；0 代表不限制
+RAG_RULES_TOKEN_BUDGET = int(os.getenv("RAG_RULES_TOKEN_BUDGET", "1024"))
+# 與已保留的 rule cosine 相似度達到此值就視為重複而略過
+RAG_RULES_DEDUP_THRESHOLD = float(os.getenv("RAG_RULES_DEDUP_THRESHOLD", "0.95"))
+
 GLOBAL_RULE_TEMPLATE = """
 Please conduct a code review according to the following global rules:
 
@@ -36,14 +43,79 @@ Please conduct a code review according to the following global rules:
 {prompt}
 """
 
-def build_global_rule_template(rag_rules=None, prompt=""):
+# 所有 stage 共用的開頭（rules 1-7），以及加上該檔案 RAG rules 之後的開頭；給 PrefixCache 切巢狀 prefix 用
+GLOBAL_RULE_PREAMBLE = GLOBAL_RULE_TEMPLATE[:GLOBAL_RULE_TEMPLATE.index("{rag_rules_section}")]
+PROMPT_CONTENT_MARKER = "# Prompt Content\n"
+GLOBAL_RULE_PREFIX_MARKERS = [GLOBAL_RULE_PREAMBLE, PROMPT_CONTENT_MARKER]
+
+
+def format_rag_rule(rule):
+    return f"   - {rule}"
+
+
+def rule_vectors(rules):
+    # 去重用的 rule 向量：有 daemon 就用它已載入的 embedding model；sparse 模式本來就不載入 embedding model，
+    # 回傳 None 略過去重，不為了去重多載一個 4B 模型
+    from codes.util import faiss_util
+    from codes.util.embedding_service import get_client
+
+    client = get_client()
+    if client is not None:
+        return client.embed(rules)
+    if faiss_util.RETRIEVAL_MODE == "sparse":
+        return None
+    return faiss_util.get_rule_embeddings(rules)
+
+
+def pack_rag_rules(
+    rag_rules,
+    tokenizer,
+    token_budget=RAG_RULES_TOKEN_BUDGET,
+    dedup_threshold=RAG_RULES_DEDUP_THRESHOLD,
+    format_rule=format_rag_rule
+):
+    # rag_rules 需已依分數由高到低排序；依序保留，直到下一條會超過 token 預算為止
+    if isinstance(rag_rules, str):
+        rag_rules = [rag_rules]
+    if not rag_rules:
+        return []
+
+    vectors = None
+    if dedup_threshold is not None and len(rag_rules) > 1:
+        vectors = rule_vectors(list(rag_rules))
+    if vectors is not None:
+        kept = []
+        for i in range(len(rag_rules)):
+            if not kept or (vectors[kept] @ vectors[i]).max() < dedup_threshold:
+                kept.append(i)
+        rag_rules = [rag_rules[i] for i in kept]
+
+    if not token_budget:
+        return list(rag_rules)
+
+    packed = []
+    used_tokens = 0
+    for rule in rag_rules:
+        n_tokens = len(tokenizer(format_rule(rule), add_special_tokens=False)["input_ids"])
+        if used_tokens + n_tokens > token_budget:
+            break
+        packed.append(rule)
+        used_tokens += n_tokens
+    return packed
+
+
+def build_global_rule_template(rag_rules=None, prompt="", tokenizer=None, token_budget=RAG_RULES_TOKEN_BUDGET):
+    # 有給 tokenizer 時先去除重複的 rule 並裁到 token_budget，prompt 長度不再隨規則庫變大
+    if tokenizer is not None:
+        rag_rules = pack_rag_rules(rag_rules, tokenizer, token_budget=token_budget)
+
     if not rag_rules:
         rag_rules_section = ""  # 忽略 RAG Rules 區塊
     else:
         if isinstance(rag_rules, list):
-            rag_rules_text = "".join(f"   - {rule}" for rule in rag_rules)
+            rag_rules_text = "".join(format_rag_rule(rule) for rule in rag_rules)
         else:
-            rag_rules_text = f"   - {rag_rules}"
+            rag_rules_text = format_rag_rule(rag_rules)
 
         rag_rules_section = f"""
 8. RAG Rules (Retrieval-Augmented Guidance)
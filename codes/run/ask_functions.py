@@ -1,9 +1,143 @@
-from codes.util.faiss_util import search_docs
+from codes.util.diff_util import is_unified_diff, parse_unified_diff
+from codes.util.embedding_service import get_client
+from codes.util.faiss_util import (
+    RETRIEVAL_MODE, search_docs, search_docs_chunked, search_docs_hybrid, search_docs_hybrid_batch
+)
 
-def get_rag_docs(prompt: str, threshold: float = 0.7) -> list[str]:
+def search_rag_docs(
+    query: str,
+    k: int = 15,
+    threshold: float = None,
+    chunked: bool = False,
+    mode: str = RETRIEVAL_MODE,
+    category: str | list[str] = None,
+    language: str | list[str] = None
+) -> tuple[list[str], list[dict]]:
 
-    retrieved_docs, filtered_results = search_docs(
+    # 有常駐的 embedding service 就交給它（共用已載入的模型與 index），沒有就在本 process 內檢索
+    client = get_client()
+    if client is not None:
+        return client.search(
+            [query], k=k, threshold=threshold, mode=mode, chunked=chunked, category=category, language=language
+        )[0]
+
+    # chunked 只適用於 dense 模式，hybrid / sparse 會忽略；embedding service 也依同樣的規則處理
+    if mode != "dense":
+        return search_docs_hybrid(
+            query=query, k=k, threshold=threshold, mode=mode, category=category, language=language
+        )
+    search = search_docs_chunked if chunked else search_docs
+    return search(query=query, k=k, threshold=threshold, category=category, language=language)
+
+
+def get_rag_docs(
+    prompt: str,
+    threshold: float = 0.7,
+    chunked: bool = False,
+    mode: str = RETRIEVAL_MODE,
+    category: str | list[str] = None,
+    language: str | list[str] = None
+) -> list[str]:
+
+    # chunked=True 時長檔案會切成重疊 window 檢索，不會被截斷（僅 dense 模式）
+    # category / language 只搜尋符合的 rule 分區，language 為 "any" 的 rule 一律適用
+    retrieved_docs, filtered_results = search_rag_docs(
         query=prompt,
-        threshold=threshold
+        threshold=threshold,
+        chunked=chunked,
+        mode=mode,
+        category=category,
+        language=language
+    )
+    return retrieved_docs
+
+
+def search_rag_docs_batch(
+    queries: list[str],
+    k: int = 15,
+    threshold: float = None,
+    mode: str = RETRIEVAL_MODE,
+    category: str | list[str] = None,
+    language: str | list[str] = None
+) -> list[tuple[list[str], list[dict]]]:
+
+    if not queries:
+        return []
+    client = get_client()
+    if client is not None:
+        return client.search(queries, k=k, threshold=threshold, mode=mode, category=category, language=language)
+    return search_docs_hybrid_batch(
+        queries=queries, k=k, threshold=threshold, mode=mode, category=category, language=language
+    )
+
+
+def get_rag_docs_per_hunk(
+    diffs: list[str],
+    threshold: float = 0.7,
+    mode: str = RETRIEVAL_MODE,
+    category: str | list[str] = None,
+    language: str | list[str] = None
+) -> list[tuple[list[str], list[dict]]]:
+
+    # 每個 unified diff 只 embed 各 hunk 新增的行，所有 diff 的 hunk 合成一個 batch 檢索
+    # 回傳每個 diff 的 (去重後依最高分排序的 rules, hunks)；hunk["rag_docs"] 是該 hunk 自己的 rules，
+    # 可以直接附在該 hunk 的 prompt 上
+    hunks_per_diff = [[h for h in parse_unified_diff(d) if h["added"].strip()] for d in diffs]
+    batch_results = iter(search_rag_docs_batch(
+        [h["added"] for hunks in hunks_per_diff for h in hunks],
+        threshold=threshold,
+        mode=mode,
+        category=category,
+        language=language
+    ))
+
+    output = []
+    for hunks in hunks_per_diff:
+        merged = {}
+        for hunk_index, hunk in enumerate(hunks):
+            retrieved_docs, filtered_results = next(batch_results)
+            hunk["rag_docs"] = retrieved_docs
+            for r in filtered_results:
+                entry = merged.setdefault(r["doc"], {"doc": r["doc"], "score": r["score"], "hunks": []})
+                entry["score"] = max(entry["score"], r["score"])
+                entry["hunks"].append(hunk_index)
+        ranked = sorted(merged.values(), key=lambda e: e["score"], reverse=True)
+        output.append(([e["doc"] for e in ranked], hunks))
+    return output
+
+
+def get_rag_docs_batch(
+    prompts: list[str],
+    threshold: float = 0.7,
+    mode: str = RETRIEVAL_MODE,
+    category: str | list[str] = None,
+    language: str | list[str] = None,
+    per_hunk: bool = False
+) -> list[list[str]]:
+
+    # per_hunk=True 時，unified diff 改用 get_rag_docs_per_hunk，不再把 header / context / 刪除行一起 embed
+    is_diff = [per_hunk and is_unified_diff(p) for p in prompts]
+    diff_positions = [i for i, d in enumerate(is_diff) if d]
+    other_positions = [i for i, d in enumerate(is_diff) if not d]
+
+    rag_docs_list = [None] * len(prompts)
+    batch_results = search_rag_docs_batch(
+        [prompts[i] for i in other_positions],
+        threshold=threshold,
+        mode=mode,
+        category=category,
+        language=language
+    )
+    for i, (retrieved_docs, filtered_results) in zip(other_positions, batch_results):
+        rag_docs_list[i] = retrieved_docs
+
+    hunk_results = get_rag_docs_per_hunk(
+        [prompts[i] for i in diff_positions],
+        threshold=threshold,
+        mode=mode,
+        category=category,
+        language=language
     )
-    return retrieved_docs
\ No newline at end of file
+    for i, (retrieved_docs, hunks) in zip(diff_positions, hunk_results):
+        rag_docs_list[i] = retrieved_docs
+    return rag_docs_list
\ No newline at end of file
@@ -3,138 +3,206 @@ from pathlib import Path
 from codes.run.CoT.code_smell_detector import CODE_SMELL_DETECTOR_TEMPLATE
 from codes.run.CoT.first_code_review import FIRST_CODE_REVIEW_TEMPLATE
 from codes.run.CoT.first_summary_prompt import FIRST_SUMMARY_TEMPLATE
-from codes.run.CoT.global_rule import build_global_rule_template
+from codes.run.CoT.global_rule import (
+    GLOBAL_RULE_PREFIX_MARKERS, RAG_RULES_TOKEN_BUDGET, build_global_rule_template, pack_rag_rules
+)
 from codes.run.CoT.linter import LINTER_TEMPLATE
 from codes.run.CoT.total_summary import TOTAL_SUMMARY_TEMPLATE
-from codes.run.ask_functions import get_rag_docs
-from codes.util.qwen3_util import load_qwen3_model, qwen3_ask
+from codes.run.ask_functions import get_rag_docs, get_rag_docs_batch
+from codes.util.continuous_batching import ContinuousBatchingEngine
+from codes.util.generation_budget import closed_json_list, generation_config, report_token_usage
+from codes.util.prefix_cache import PrefixCache
+from codes.util.qwen3_util import load_qwen3_model, qwen3_ask, qwen3_ask_stream, report_stream_timings
 
 RUN_ON = "Qwen2.5-Coder"
 
 # 載入 Qwen 的生成模型，用來生成答案
 match RUN_ON:
     case "Qwen3.1-7B":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen3-1.7B",
             lora_path="../train/outputs-lora-qwen3-1.7b")
     case "Qwen2.5-Coder":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen2.5-Coder-7B-Instruct",
             lora_path="../train/outputs-lora-qwen2.5-coder-7b")
     case _:
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             lora_path="../train/outputs-lora-qwen3-30b")
 
-def code_review(code_for_review: str, code_file_path: Path, folder_prefix_name: str):
+# 五個 stage 共用 GLOBAL_RULE_TEMPLATE 的 rules 1-7，同一個檔案的 RAG rules 區塊也相同，這兩層 prefix 只 prefill 一次
+prefix_cache = PrefixCache(gen_model, gen_tokenizer, markers=GLOBAL_RULE_PREFIX_MARKERS)
+
+# 每個檔案的 RAG rules 只依這個 token 預算裁一次，五個 stage 放入完全相同的 rules 區塊，
+# 第二層 prefix（rules 1-7 + 該檔案的 RAG rules）才能共用；prefill 與 KV cache 不再隨規則庫成長
+RAG_RULE_TOKEN_BUDGET = RAG_RULES_TOKEN_BUDGET
+
+# 各 stage 的生成上限與停止條件，取代一律 max_new_tokens=32768；一個失控的 stage 不會吃掉整個時間預算
+STAGE_GENERATION_CONFIGS = {
+    "first_summary": generation_config(max_new_tokens=8192, max_thinking_tokens=6144),
+    "first_code_review": generation_config(max_new_tokens=16384, max_thinking_tokens=12288),
+    # linter 只需要輸出 linter_messages list，list 一閉合就停止
+    "linter": generation_config(max_new_tokens=8192, max_thinking_tokens=6144, stop_when=closed_json_list),
+    "code_smell": generation_config(max_new_tokens=16384, max_thinking_tokens=12288),
+    "total_summary": generation_config(max_new_tokens=12288, max_thinking_tokens=8192),
+}
+
+# 前四個 stage 只依賴原始碼，total_summary 需要前四個 stage 的結果
+INDEPENDENT_STAGES = {
+    "first_summary": FIRST_SUMMARY_TEMPLATE,
+    "first_code_review": FIRST_CODE_REVIEW_TEMPLATE,
+    "linter": LINTER_TEMPLATE,
+    "code_smell": CODE_SMELL_DETECTOR_TEMPLATE,
+}
+
+# True: 所有檔案 x stage 一起交給 continuous batching engine；False: 逐檔逐 stage 呼叫 qwen3_ask
+USE_CONTINUOUS_BATCHING = True
+# 邊生成邊寫入 *_result.md / *_thinking.md，長時間生成中途也能查看，中斷時不會全部遺失（兩種模式都適用）
+USE_STREAMING = True
+# 生成因重複而中止時換一組取樣設定重試一次（兩種模式、streaming 與否都適用）
+RETRY_DEGENERATE = True
+
+
+def pack_file_rules(rag_docs: list[str]) -> list[str]:
+    return pack_rag_rules(rag_docs, gen_tokenizer, token_budget=RAG_RULE_TOKEN_BUDGET)
+
+
+def build_stage_prompt(stage: str, code_for_review: str, rag_rules: list[str], stage_results: dict = None) -> str:
+    # rag_rules 是 pack_file_rules 裁好的結果，這裡不再重新裁切
+    if stage == "total_summary":
+        prompt = TOTAL_SUMMARY_TEMPLATE.format(
+            first_code_review=stage_results["first_code_review"],
+            first_summary=stage_results["first_summary"],
+            linter_result=stage_results["linter"],
+            code_smell_result=stage_results["code_smell"],
+            code_diff=code_for_review,
+        )
+    else:
+        prompt = INDEPENDENT_STAGES[stage].format(code_diff=code_for_review)
+    return build_global_rule_template(prompt=prompt, rag_rules=rag_rules)
+
+
+def review_folder(code_file_path: Path, folder_prefix_name: str) -> Path:
     folder_path = Path(folder_prefix_name + "_" + str(code_file_path.stem))
     Path.mkdir(folder_path, exist_ok=True)
+    return folder_path
 
-    if Path(folder_path).is_dir():
-        rag_docs = get_rag_docs(prompt=code_for_review, threshold=0.7)
 
-        first_summary = build_global_rule_template(
-            prompt=FIRST_SUMMARY_TEMPLATE.format(code_diff=code_for_review),
-            rag_rules=rag_docs
-        )
-        first_summary_result = qwen3_ask(first_summary, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
-        with open(str(Path(str(folder_path) + "/" + "first_summary_result.md")), "w", encoding="utf-8") as f:
-            f.write(first_summary_result)
+def stage_result_path(folder_path: Path, stage: str, suffix: str = "result") -> Path:
+    return Path(str(folder_path) + "/" + stage + "_" + suffix + ".md")
 
-        first_code_review = build_global_rule_template(
-            prompt=FIRST_CODE_REVIEW_TEMPLATE.format(code_diff=code_for_review),
-            rag_rules=rag_docs
-        )
-        first_code_review_result = qwen3_ask(first_code_review, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
-        with open(str(Path(str(folder_path) + "/" + "first_code_review_result.md")), "w", encoding="utf-8") as f:
-            f.write(first_code_review_result)
 
-        linter = build_global_rule_template(
-            prompt=LINTER_TEMPLATE.format(code_diff=code_for_review),
-            rag_rules=rag_docs
-        )
-        linter_result = qwen3_ask(linter, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
-        with open(str(Path(str(folder_path) + "/" + "linter_result.md")), "w", encoding="utf-8") as f:
-            f.write(linter_result)
+def write_stage_result(folder_path: Path, stage: str, result: str) -> None:
+    with open(str(stage_result_path(folder_path, stage)), "w", encoding="utf-8") as f:
+        f.write(result)
 
-        code_smell = build_global_rule_template(
-            prompt=CODE_SMELL_DETECTOR_TEMPLATE.format(code_diff=code_for_review),
-            rag_rules=rag_docs
-        )
-        code_smell_result = qwen3_ask(code_smell, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
-        with open(str(Path(str(folder_path) + "/" + "code_smell_result.md")), "w", encoding="utf-8") as f:
-            f.write(code_smell_result)
-
-        total_summary = build_global_rule_template(
-            prompt=TOTAL_SUMMARY_TEMPLATE.format(
-                first_code_review=first_code_review_result,
-                first_summary=first_summary_result,
-                linter_result=linter_result,
-                code_smell_result=code_smell_result,
-                code_diff=code,
-            ),
-            rag_rules=rag_docs)
-        total_summary_result = qwen3_ask(total_summary, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
-        with open(str(Path(str(folder_path) + "/" + "total_summary_result.md")), "w", encoding="utf-8") as f:
-            f.write(total_summary_result)
+
+def ask_stage(stage_prompt: str, folder_path: Path, stage: str) -> str:
+    if USE_STREAMING:
+        return qwen3_ask_stream(stage_prompt, gen_model, gen_tokenizer,
+                                prefix_cache=prefix_cache, stage=stage,
+                                answer_path=stage_result_path(folder_path, stage),
+                                thinking_path=stage_result_path(folder_path, stage, "thinking"),
+                                stage_config=STAGE_GENERATION_CONFIGS[stage], retry_degenerate=RETRY_DEGENERATE)[0]
+    result = qwen3_ask(stage_prompt, gen_model, gen_tokenizer, prefix_cache=prefix_cache, stage=stage,
+                       stage_config=STAGE_GENERATION_CONFIGS[stage], retry_degenerate=RETRY_DEGENERATE)[0]
+    write_stage_result(folder_path, stage, result)
+    return result
+
+
+def code_review(code_for_review: str, code_file_path: Path, folder_prefix_name: str, rag_docs: list[str] = None):
+    folder_path = review_folder(code_file_path, folder_prefix_name)
+
+    if Path(folder_path).is_dir():
+        if rag_docs is None:
+            rag_docs = get_rag_docs(prompt=code_for_review, threshold=0.7)
+        rag_rules = pack_file_rules(rag_docs)
+
+        stage_results = {}
+        for stage in INDEPENDENT_STAGES:
+            stage_prompt = build_stage_prompt(stage, code_for_review, rag_rules)
+            stage_results[stage] = ask_stage(stage_prompt, folder_path, stage)
+
+        total_summary = build_stage_prompt("total_summary", code_for_review, rag_rules, stage_results)
+        ask_stage(total_summary, folder_path, "total_summary")
         print(folder_prefix_name + code_file_path.stem + "  " * 2 + "Generation completed.")
 
+
+def submit_stage(engine: ContinuousBatchingEngine, stage_prompt: str, job_index: int, stage: str,
+                 folder_path: Path) -> None:
+    stream_paths = {}
+    if USE_STREAMING:
+        stream_paths = {"answer_path": stage_result_path(folder_path, stage),
+                        "thinking_path": stage_result_path(folder_path, stage, "thinking")}
+    engine.submit(stage_prompt, request_id=(job_index, stage), stage=stage,
+                  stage_config=STAGE_GENERATION_CONFIGS[stage], retry_degenerate=RETRY_DEGENERATE, **stream_paths)
+
+
+def code_review_continuous(review_jobs: list[tuple[str, Path, str]], rag_docs_list: list[list[str]]):
+    # 所有檔案的前四個 stage 一次送出；某個檔案的四個結果到齊時，再送出它的 total_summary
+    engine = ContinuousBatchingEngine(gen_model, gen_tokenizer, prefix_cache=prefix_cache)
+    stage_results = [{} for _ in review_jobs]
+    rag_rules_list = [pack_file_rules(rag_docs) for rag_docs in rag_docs_list]
+    for job_index, (code, file_path, folder_prefix_name) in enumerate(review_jobs):
+        folder_path = review_folder(file_path, folder_prefix_name)
+        for stage in INDEPENDENT_STAGES:
+            submit_stage(engine, build_stage_prompt(stage, code, rag_rules_list[job_index]), job_index, stage,
+                         folder_path)
+
+    for (job_index, stage), content, thinking_content in engine.run():
+        code, file_path, folder_prefix_name = review_jobs[job_index]
+        folder_path = review_folder(file_path, folder_prefix_name)
+        # streaming 時檔案已經邊生成邊寫好，這裡再寫一次去掉頭尾空行的最終結果
+        write_stage_result(folder_path, stage, content)
+        stage_results[job_index][stage] = content
+
+        if stage == "total_summary":
+            print(folder_prefix_name + file_path.stem + "  " * 2 + "Generation completed.")
+        elif len(stage_results[job_index]) == len(INDEPENDENT_STAGES):
+            submit_stage(
+                engine,
+                build_stage_prompt("total_summary", code, rag_rules_list[job_index], stage_results[job_index]),
+                job_index, "total_summary", folder_path
+            )
+    print(f"Aggregate generation throughput: {engine.tokens_per_second():.1f} tokens/s")
+
+
+DATASETS = [
+    ("../../datas/code_to_detect/bad_data/Python/Copilot", "cot_copilot_bad_data"),
+    ("../../datas/code_to_detect/bad_data/Python/ChatGPT", "cot_chatgpt_bad_data"),
+    ("../../datas/code_to_detect/code_diff/Python/ChatGPT", "cot_chatgpt_code_diff"),
+    ("../../datas/code_to_detect/code_diff/Python/Copilot", "cot_copilot_code_diff"),
+    ("../../datas/code_to_detect/only_code/Python/ChatGPT", "cot_chatgpt_only_code"),
+    ("../../datas/code_to_detect/only_code/Python/Copilot", "cot_copilot_only_code"),
+]
+
+
+def load_review_jobs() -> list[tuple[str, Path, str]]:
+    review_jobs = []
+    for folder, folder_prefix_name in DATASETS:
+        file_path_list = [f for f in Path(folder).iterdir() if f.is_file()]
+        print(file_path_list)
+
+        for file_path in file_path_list:
+            with open(file_path, encoding="utf-8") as f:
+                review_jobs.append((f.read(), file_path, folder_prefix_name))
+    return review_jobs
+
+
 if __name__ == "__main__":
-    copilot_bad_data_file_path_list = [f for f in
-                                       Path("../../datas/code_to_detect/bad_data/Python/Copilot").iterdir() if
-                                       f.is_file()]
-    print(copilot_bad_data_file_path_list)
-
-    for file_path in copilot_bad_data_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_copilot_bad_data")
-
-    chatgpt_bad_data_file_path_list = [f for f in
-                                       Path("../../datas/code_to_detect/bad_data/Python/ChatGPT").iterdir() if
-                                       f.is_file()]
-    print(chatgpt_bad_data_file_path_list)
-
-    for file_path in chatgpt_bad_data_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_chatgpt_bad_data")
-
-    chatgpt_code_diff_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/code_diff/Python/ChatGPT").iterdir() if
-                                        f.is_file()]
-    print(chatgpt_code_diff_file_path_list)
-
-    for file_path in chatgpt_code_diff_file_path_list:
-        with open(file_path, "r", encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_chatgpt_code_diff")
-
-    copilot_code_diff_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/code_diff/Python/Copilot").iterdir() if
-                                        f.is_file()]
-    print(copilot_code_diff_file_path_list)
-
-    for file_path in copilot_code_diff_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_copilot_code_diff")
-
-    chatgpt_only_code_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/only_code/Python/ChatGPT").iterdir() if
-                                        f.is_file()]
-    print(chatgpt_only_code_file_path_list)
-
-    for file_path in chatgpt_only_code_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_chatgpt_only_code")
-
-    copilot_only_code_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/only_code/Python/Copilot").iterdir() if
-                                        f.is_file()]
-    print(copilot_only_code_file_path_list)
-
-    for file_path in copilot_only_code_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name="cot_copilot_only_code")
+    review_jobs = load_review_jobs()
+
+    # 開始生成前，一次檢索所有檔案的 RAG rules
+    rag_docs_list = get_rag_docs_batch(
+        [code for code, _, _ in review_jobs], threshold=0.7, language="python", per_hunk=True
+    )
+
+    if USE_CONTINUOUS_BATCHING:
+        code_review_continuous(review_jobs, rag_docs_list)
+    else:
+        for (code, file_path, folder_prefix_name), rag_docs in zip(review_jobs, rag_docs_list):
+            code_review(code_for_review=code, code_file_path=file_path, folder_prefix_name=folder_prefix_name,
+                        rag_docs=rag_docs)
+    report_stream_timings()
+    prefix_cache.report()
+    report_token_usage()
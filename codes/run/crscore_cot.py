@@ -2,6 +2,7 @@ import datetime
 from pathlib import Path
 
 from codes.run.CoT.step_by_step_analysis import STEP_BY_STEP_ANALYSIS_TEMPLATE
+from codes.util.generation_budget import generation_config, report_token_usage
 from codes.util.qwen3_util import load_qwen3_model, qwen3_ask
 
 RUN_ON = "Qwen3-32B"
@@ -9,17 +10,31 @@ RUN_ON = "Qwen3-32B"
 # 載入 Qwen 的生成模型，用來生成答案
 match RUN_ON:
     case "Qwen3.1-7B":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen3-1.7B",
             lora_path="../train/outputs-lora-qwen3-1.7b")
     case "Qwen2.5-Coder":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen2.5-Coder-7B-Instruct",
             lora_path="../train/outputs-lora-qwen2.5-coder-7b")
     case _:
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             lora_path="../train/outputs-lora-qwen3-30b")
 
+# CRSCORE 的評分只需要 "### Final Scores:" 後的 JSON 區塊，區塊一結束就停止
+FINAL_SCORES_PATTERN = r'```(?:json)?\s*\{{[^`]*"{key}"[^`]*\}}\s*```'
+
+STAGE_GENERATION_CONFIGS = {
+    "step_by_step_analysis": generation_config(max_new_tokens=16384, max_thinking_tokens=12288),
+    # crscore_cot_evaluation 的 prompt 以 "### Final Scores:" 結尾，模型直接輸出含 accuracy 的 JSON 區塊
+    "crscore_cot_evaluation": generation_config(
+        max_new_tokens=8192, max_thinking_tokens=6144,
+        stop_patterns=[FINAL_SCORES_PATTERN.format(key="accuracy")]),
+    "crscore_llm_as_judge": generation_config(
+        max_new_tokens=8192, max_thinking_tokens=6144,
+        stop_patterns=[r"### Final Scores:?\s*" + FINAL_SCORES_PATTERN.format(key="relevance")]),
+}
+
 
 def list_and_ask_qwen(root_folder: str):
     root_path = Path(root_folder)
@@ -43,7 +58,8 @@ def list_and_ask_qwen(root_folder: str):
                     code_smell_result=code_smell_result
                 )
                 step_by_step_analysis_result = qwen3_ask(
-                    step_by_step_analysis, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
+                    step_by_step_analysis, gen_model, gen_tokenizer, stage="step_by_step_analysis",
+                    stage_config=STAGE_GENERATION_CONFIGS["step_by_step_analysis"])[0]
                 with open(str(Path(str(folder_path) + "/" + "step_by_step_analysis_result.md")), "w",
                           encoding="utf-8") as f:
                     f.write(step_by_step_analysis_result)
@@ -56,3 +72,4 @@ def list_and_ask_qwen(root_folder: str):
 if __name__ == "__main__":
     target_folder = "./cot"
     list_and_ask_qwen(target_folder)
+    report_token_usage()
@@ -2,7 +2,10 @@ from Skills.code_review import CODE_REVIEW_SKILL_TEMPLATE
 from Skills.code_explainer import CODE_EXPLAINER_TEMPLATE
 from pathlib import Path
 
-from codes.run.ask_functions import get_rag_docs
+from codes.run.CoT.global_rule import RAG_RULES_TOKEN_BUDGET, pack_rag_rules
+from codes.run.ask_functions import get_rag_docs, get_rag_docs_batch
+from codes.util.continuous_batching import ContinuousBatchingEngine
+from codes.util.generation_budget import generation_config, report_token_usage
 from codes.util.qwen3_util import load_qwen3_model, qwen3_ask
 
 RUN_ON = "Qwen2.5-Coder"
@@ -10,24 +13,33 @@ RUN_ON = "Qwen2.5-Coder"
 # 載入 Qwen 的生成模型，用來生成答案
 match RUN_ON:
     case "Qwen3.1-7B":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen3-1.7B",
             lora_path="../train/outputs-lora-qwen3-1.7b")
     case "Qwen2.5-Coder":
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             model_name="Qwen/Qwen2.5-Coder-7B-Instruct",
             lora_path="../train/outputs-lora-qwen2.5-coder-7b")
     case _:
-        gen_tokenizer, gen_model = load_qwen3_model(
+        gen_model, gen_tokenizer = load_qwen3_model(
             lora_path="../train/outputs-lora-qwen3-30b")
 
+# 各 skill 的生成上限，取代一律 max_new_tokens=32768
+SKILL_GENERATION_CONFIGS = {
+    "code_explainer": generation_config(max_new_tokens=12288, max_thinking_tokens=8192),
+    "code_review": generation_config(max_new_tokens=16384, max_thinking_tokens=12288),
+}
+
 rag_prompt = """
 {rag_rules_section}
 
 {prompt}
 """
 
-def build_rag_string(rag_rules=None, prompt=""):
+def build_rag_string(rag_rules=None, prompt="", tokenizer=None, token_budget=RAG_RULES_TOKEN_BUDGET):
+    if tokenizer is not None:
+        rag_rules = pack_rag_rules(rag_rules, tokenizer, token_budget=token_budget, format_rule=str)
+
     if not rag_rules:
         rag_rules_section = ""
     elif isinstance(rag_rules, list):
@@ -43,93 +55,107 @@ def build_rag_string(rag_rules=None, prompt=""):
 
 
 
-def ai_response(code_for_review: str, code_file_path: Path, folder_prefix_name: str):
+def ai_response(code_for_review: str, code_file_path: Path, folder_prefix_name: str, rag_docs: list[str] = None):
     folder_path = Path(folder_prefix_name + "_" + str(code_file_path.stem))
     Path.mkdir(folder_path, exist_ok=True)
 
-    rag_docs = get_rag_docs(code_for_review)
+    if rag_docs is None:
+        rag_docs = get_rag_docs(code_for_review)
 
     code_explainer_prompt = build_rag_string(
         prompt=CODE_EXPLAINER_TEMPLATE.format(code_diff=code_for_review),
-        rag_rules=rag_docs
+        rag_rules=rag_docs,
+        tokenizer=gen_tokenizer
     )
     print(code_explainer_prompt)
-    result = qwen3_ask(code_explainer_prompt, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
+    result = qwen3_ask(code_explainer_prompt, gen_model, gen_tokenizer, stage="code_explainer",
+                       stage_config=SKILL_GENERATION_CONFIGS["code_explainer"])[0]
 
     with open(str(Path(str(folder_path) + "/" + "code_explainer.md")), "w", encoding="utf-8") as f:
         f.write(result)
 
-    rag_docs = get_rag_docs(code_for_review)
-
     code_review_prompt = build_rag_string(
         prompt=CODE_REVIEW_SKILL_TEMPLATE.format(code_diff=code_for_review),
-        rag_rules=rag_docs
+        rag_rules=rag_docs,
+        tokenizer=gen_tokenizer
     )
 
     print(code_review_prompt)
 
-    result = qwen3_ask(code_review_prompt, gen_tokenizer, gen_model, max_new_tokens=32768)[0]
+    result = qwen3_ask(code_review_prompt, gen_model, gen_tokenizer, stage="code_review",
+                       stage_config=SKILL_GENERATION_CONFIGS["code_review"])[0]
     with open(str(Path(str(folder_path) + "/" + "code_review.md")), "w", encoding="utf-8") as f:
         f.write(result)
 
+
+# 每個檔案要跑的 skill：(輸出檔名, prompt template)
+SKILL_STAGES = {
+    "code_explainer": CODE_EXPLAINER_TEMPLATE,
+    "code_review": CODE_REVIEW_SKILL_TEMPLATE,
+}
+
+# True: 所有檔案 x skill 一起交給 continuous batching engine；False: 逐檔呼叫 ai_response
+USE_CONTINUOUS_BATCHING = True
+
+
+def ai_response_continuous(review_jobs: list[tuple[str, Path, str]], rag_docs_list: list[list[str]]):
+    engine = ContinuousBatchingEngine(gen_model, gen_tokenizer)
+    for job_index, (code, _, _) in enumerate(review_jobs):
+        for stage, template in SKILL_STAGES.items():
+            engine.submit(
+                build_rag_string(
+                    prompt=template.format(code_diff=code),
+                    rag_rules=rag_docs_list[job_index],
+                    tokenizer=gen_tokenizer
+                ),
+                request_id=(job_index, stage),
+                stage=stage,
+                stage_config=SKILL_GENERATION_CONFIGS[stage]
+            )
+
+    for (job_index, stage), content, thinking_content in engine.run():
+        _, file_path, folder_prefix_name = review_jobs[job_index]
+        folder_path = Path(folder_prefix_name + "_" + str(file_path.stem))
+        Path.mkdir(folder_path, exist_ok=True)
+        with open(str(Path(str(folder_path) + "/" + stage + ".md")), "w", encoding="utf-8") as f:
+            f.write(content)
+    print(f"Aggregate generation throughput: {engine.tokens_per_second():.1f} tokens/s")
+
+
+DATASETS = [
+    ("../../datas/code_to_detect/bad_data/Python/Copilot", "skills_copilot_bad_data"),
+    ("../../datas/code_to_detect/bad_data/Python/ChatGPT", "skills_chatgpt_bad_data"),
+    ("../../datas/code_to_detect/code_diff/Python/ChatGPT", "skills_chatgpt_code_diff"),
+    ("../../datas/code_to_detect/code_diff/Python/Copilot", "skills_copilot_code_diff"),
+    ("../../datas/code_to_detect/only_code/Python/ChatGPT", "skills_chatgpt_only_code"),
+    ("../../datas/code_to_detect/only_code/Python/Copilot", "skills_copilot_only_code"),
+]
+
+
+def load_review_jobs() -> list[tuple[str, Path, str]]:
+    review_jobs = []
+    for folder, folder_prefix_name in DATASETS:
+        file_path_list = [f for f in Path(folder).iterdir() if f.is_file()]
+        print(file_path_list)
+
+        for file_path in file_path_list:
+            with open(file_path, encoding="utf-8") as f:
+                review_jobs.append((f.read(), file_path, folder_prefix_name))
+    return review_jobs
+
+
 if __name__ == "__main__":
+    review_jobs = load_review_jobs()
+
+    # 開始生成前，一次檢索所有檔案的 RAG rules
+    rag_docs_list = get_rag_docs_batch(
+        [code for code, _, _ in review_jobs], threshold=0.7, language="python", per_hunk=True
+    )
 
-    copilot_bad_data_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/bad_data/Python/Copilot").iterdir() if
-                                        f.is_file()]
-    print(copilot_bad_data_file_path_list)
-
-    for file_path in copilot_bad_data_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_copilot_bad_data")
-
-    chatgpt_bad_data_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/bad_data/Python/ChatGPT").iterdir() if
-                                        f.is_file()]
-    print(chatgpt_bad_data_file_path_list)
-
-    for file_path in chatgpt_bad_data_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_chatgpt_bad_data")
-
-    chatgpt_code_diff_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/code_diff/Python/ChatGPT").iterdir() if
-                                        f.is_file()]
-    print(chatgpt_code_diff_file_path_list)
-
-    for file_path in chatgpt_code_diff_file_path_list:
-        with open(file_path, "r", encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_chatgpt_code_diff")
-
-    copilot_code_diff_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/code_diff/Python/Copilot").iterdir() if
-                                        f.is_file()]
-    print(copilot_code_diff_file_path_list)
-
-    for file_path in copilot_code_diff_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_copilot_code_diff")
-
-    chatgpt_only_code_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/only_code/Python/ChatGPT").iterdir() if
-                                        f.is_file()]
-    print(chatgpt_only_code_file_path_list)
-
-    for file_path in chatgpt_only_code_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_chatgpt_only_code")
-
-    copilot_only_code_file_path_list = [f for f in
-                                        Path("../../datas/code_to_detect/only_code/Python/Copilot").iterdir() if
-                                        f.is_file()]
-    print(copilot_only_code_file_path_list)
-
-    for file_path in copilot_only_code_file_path_list:
-        with open(file_path, encoding="utf-8") as f:
-            code = f.read()
-            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name="skills_copilot_only_code")
+    if USE_CONTINUOUS_BATCHING:
+        ai_response_continuous(review_jobs, rag_docs_list)
+    else:
+        for (code, file_path, folder_prefix_name), rag_docs in zip(review_jobs, rag_docs_list):
+            ai_response(code_for_review=code, code_file_path=file_path, folder_prefix_name=folder_prefix_name,
+                        rag_docs=rag_docs)
+    report_token_usage()
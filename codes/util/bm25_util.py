@@ -0,0 +1,104 @@
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# =========================
+# Tokenizer
+# =========================
+WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+SUBWORD_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for word in WORD_PATTERN.findall(text):
+        tokens.append(word.lower())
+        # snake_case / camelCase 再拆成子詞，例如 get_rag_docs -> get, rag, docs
+        parts = SUBWORD_PATTERN.findall(word)
+        if len(parts) > 1:
+            tokens.extend(p.lower() for p in parts)
+    return tokens
+
+# =========================
+# Sparse BM25 index
+# =========================
+class BM25Index:
+
+    def __init__(self, docs: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.vocab: Dict[str, int] = {}
+
+        counts = self._count_matrix([tokenize(d) for d in docs], grow_vocab=True)
+        n_docs = counts.shape[0]
+        doc_len = np.asarray(counts.sum(axis=1)).ravel()
+        avg_len = doc_len.mean() if n_docs else 0.0
+
+        df = np.bincount(counts.indices, minlength=len(self.vocab))
+        self.idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+        # 預先把 BM25 權重算進稀疏矩陣，查詢時只剩一次 sparse mat-vec
+        tf = counts.data
+        row_len = np.repeat(doc_len, np.diff(counts.indptr))
+        norm = k1 * (1.0 - b + b * row_len / max(avg_len, 1e-9))
+        weights = self.idf[counts.indices] * tf * (k1 + 1.0) / (tf + norm)
+        self.doc_term = sparse.csr_matrix(
+            (weights, counts.indices.copy(), counts.indptr.copy()),
+            shape=counts.shape
+        )
+
+    def _count_matrix(self, tokenized: List[List[str]], grow_vocab: bool = False) -> sparse.csr_matrix:
+        rows, cols = [], []
+        for row, tokens in enumerate(tokenized):
+            for token in tokens:
+                col = self.vocab.get(token)
+                if col is None:
+                    if not grow_vocab:
+                        continue
+                    col = self.vocab[token] = len(self.vocab)
+                rows.append(row)
+                cols.append(col)
+        data = np.ones(len(rows), dtype="float32")
+        matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(tokenized), len(self.vocab)))
+        # csr_matrix 會把重複 (row, col) 加總成詞頻
+        matrix.sum_duplicates()
+        return matrix
+
+    def scores(self, queries: List[str]) -> np.ndarray:
+        query_terms = self._count_matrix([tokenize(q) for q in queries])
+        return np.asarray((query_terms @ self.doc_term.T).todense(), dtype="float32")
+
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = 15,
+        mask: np.ndarray | None = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # 回傳格式與 faiss index.search 相同：(scores, ids)，沒有命中的位置為 -1
+        # mask 為 False 的 doc 不會出現在結果中
+        all_scores = self.scores(queries)
+        if mask is not None:
+            all_scores[:, ~mask] = 0
+        k = min(k, all_scores.shape[1])
+        top = np.argsort(-all_scores, axis=1, kind="stable")[:, :k]
+        top_scores = np.take_along_axis(all_scores, top, axis=1)
+        top[top_scores <= 0] = -1
+        return top_scores, top
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], n_docs: int, rrf_k: int = RRF_K) -> np.ndarray:
+    # rankings: 每個 retriever 的 (n_queries, k) id 矩陣，-1 代表沒有結果
+    n_queries = rankings[0].shape[0]
+    fused = np.zeros((n_queries, n_docs), dtype="float32")
+    for ids in rankings:
+        rank_scores = 1.0 / (rrf_k + np.arange(1, ids.shape[1] + 1, dtype="float32"))
+        rows, cols = np.nonzero(ids != -1)
+        np.add.at(fused, (rows, ids[rows, cols]), rank_scores[cols])
+    return fused
@@ -0,0 +1,273 @@
+import copy
+import datetime
+import time
+from collections import deque
+from pathlib import Path
+from typing import Iterator
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, LogitsProcessorList
+
+from codes.util.generation_budget import (
+    RETRY_SAMPLING, StageStopper, force_think_end, generation_config, log_token_usage, prompt_opens_thinking
+)
+from codes.util.prefix_cache import PrefixCache
+from codes.util.qwen3_util import StageFileStreamer, build_chat_text, eos_token_ids, split_thinking
+
+MAX_BATCH_SIZE = 8
+
+
+class GenerationRequest:
+
+    def __init__(self, request_id, text: str, input_ids: list[int], stopper: StageStopper,
+                 logits_processor: LogitsProcessorList, do_sample: bool, stage: str = "default",
+                 stream_paths: dict = None, retries: int = 0, submitted_at: float = None, timing: dict = None):
+        self.request_id = request_id
+        self.text = text
+        self.stage = stage
+        self.input_ids = input_ids
+        self.stopper = stopper
+        self.logits_processor = logits_processor
+        self.do_sample = do_sample
+        self.stream_paths = stream_paths or {}
+        self.submitted_at = time.perf_counter() if submitted_at is None else submitted_at
+        self.streamer = None
+        if stream_paths:
+            self.streamer = StageFileStreamer(stopper.tokenizer, text, **stream_paths, stage=stage,
+                                              start=self.submitted_at, timing=timing)
+        # 因重複而中止時還能重試幾次
+        self.retries = retries
+        self.max_new_tokens = stopper.config["max_new_tokens"]
+        self.output_ids: list[int] = []
+
+    def append(self, token: int) -> None:
+        self.output_ids.append(token)
+        self.stopper.update([token])
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token]))
+
+    @property
+    def position(self) -> int:
+        # 最後一個已產生 token 的 position id
+        return len(self.input_ids) + len(self.output_ids) - 1
+
+
+def _left_pad(states: torch.Tensor, length: int) -> torch.Tensor:
+    # [batch, heads, seq, head_dim] 在 seq 維度左側補 0
+    return F.pad(states, (0, 0, length - states.shape[-2], 0))
+
+
+class ContinuousBatchingEngine:
+    # 以 token 為單位的 continuous batching：每個 request 在 batch 裡佔一個 KV cache row，
+    # 有自己的 max_new_tokens；做完的 request 立刻離開 batch，等待中的 request 立刻補進來，
+    # 不會有一個 32k token 的生成拖住整個 batch
+
+    def __init__(self, model, tokenizer, max_batch_size: int = MAX_BATCH_SIZE, prefix_cache: PrefixCache = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.eos_ids = eos_token_ids(model, tokenizer)
+        self.generation_config = copy.deepcopy(model.generation_config)
+        self.model._prepare_special_tokens(self.generation_config, device=model.device)
+
+        self.waiting: deque[GenerationRequest] = deque()
+        self.running: list[GenerationRequest] = []
+        self.cache: DynamicCache | None = None
+        self.attention_mask: torch.Tensor | None = None
+
+        self._next_request_id = 0
+        self.generated_tokens = 0
+        self.busy_seconds = 0.0
+
+    def _build_logits_processor(self, prompt_length: int, sampling: dict = None) -> tuple[LogitsProcessorList, bool]:
+        # 與 model.generate 相同的 processor 組合（repetition_penalty、min_new_tokens、suppress_tokens…，
+        # do_sample 時再加上 temperature / top_k / top_p 等 warper）；有些 processor 依 prompt 長度計算，每個 request 各一份。
+        # sampling 覆蓋 generation_config 的取樣設定（重試時的 RETRY_SAMPLING）；回傳 (processors, do_sample)
+        config = self.generation_config
+        if sampling:
+            config = copy.deepcopy(config)
+            config.update(**sampling)
+        processors = self.model._get_logits_processor(
+            config, input_ids_seq_length=prompt_length, device=self.model.device
+        )
+        return processors, bool(config.do_sample)
+
+    def submit(self, prompt: str, max_new_tokens: int = 16784, request_id=None, stage: str = "default",
+               stage_config: dict = None, max_thinking_tokens: int = None, answer_path: Path = None,
+               thinking_path: Path = None, retry_degenerate: bool = False):
+        # 可以在 run() 進行中隨時加入新的 request；stage_config 會覆蓋 max_new_tokens，
+        # max_thinking_tokens 會覆蓋 stage_config 裡的 thinking 預算；
+        # 給 answer_path / thinking_path 時邊生成邊寫入檔案，與 qwen3_ask_stream 相同；
+        # retry_degenerate: 因重複而中止時，改用 RETRY_SAMPLING 重新排入一次
+        if request_id is None:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+        text = build_chat_text(prompt, self.tokenizer)
+        input_ids = self.tokenizer(text)["input_ids"]
+        config = stage_config if stage_config is not None else generation_config(max_new_tokens=max_new_tokens)
+        if max_thinking_tokens is not None:
+            config = {**config, "max_thinking_tokens": max_thinking_tokens}
+        stream_paths = {}
+        if answer_path is not None or thinking_path is not None:
+            stream_paths = {"answer_path": answer_path, "thinking_path": thinking_path}
+        stopper = StageStopper(self.tokenizer, config, thinking=prompt_opens_thinking(text))
+        logits_processor, do_sample = self._build_logits_processor(len(input_ids))
+        self.waiting.append(GenerationRequest(request_id, text, input_ids, stopper, logits_processor, do_sample,
+                                              stage=stage, stream_paths=stream_paths,
+                                              retries=1 if retry_degenerate else 0))
+        return request_id
+
+    def _retry(self, request: GenerationRequest) -> GenerationRequest:
+        # 同一個 request 從頭再生成一次，換成 RETRY_SAMPLING；streaming 的檔案也重新寫
+        print(datetime.datetime.now(), f"[{request.stage}] Degenerate repetition detected, generation aborted.")
+        stopper = StageStopper(self.tokenizer, request.stopper.config, thinking=prompt_opens_thinking(request.text))
+        logits_processor, do_sample = self._build_logits_processor(len(request.input_ids), RETRY_SAMPLING)
+        return GenerationRequest(request.request_id, request.text, request.input_ids, stopper, logits_processor,
+                                 do_sample, stage=request.stage, stream_paths=request.stream_paths,
+                                 retries=request.retries - 1, submitted_at=request.submitted_at,
+                                 timing=request.streamer.timing if request.streamer is not None else None)
+
+    def _next_tokens(self, logits: torch.Tensor, requests: list[GenerationRequest]) -> list[int]:
+        scores = logits.float()
+        for row, request in enumerate(requests):
+            # 每個 row 的序列長度不同，processor 逐 row 套用在各自的 prompt + 已產生的 token 上
+            if request.logits_processor:
+                input_ids = torch.tensor([request.input_ids + request.output_ids], device=scores.device)
+                scores[row] = request.logits_processor(input_ids, scores[row:row + 1])[0]
+            # thinking 超過預算時強制輸出 </think>
+            if request.stopper.over_thinking_budget():
+                scores[row] = force_think_end(scores[row])
+        tokens = scores.argmax(dim=-1)
+        sample_rows = [row for row, request in enumerate(requests) if request.do_sample]
+        if sample_rows:
+            probs = torch.softmax(scores[sample_rows], dim=-1)
+            tokens[sample_rows] = torch.multinomial(probs, num_samples=1).squeeze(1)
+        return tokens.tolist()
+
+    def _prefill(self, request: GenerationRequest) -> None:
+        # 新 request 單獨 prefill，再把它的 KV 併進正在跑的 batch；有 prefix cache 時只 prefill 不同的部分
+        prefix_length, past_key_values = 0, None
+        if self.prefix_cache is not None:
+            _, prefix_length, past_key_values = self.prefix_cache.lookup(request.text, label=request.stage)
+        input_ids = torch.tensor([request.input_ids[prefix_length:]], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values if past_key_values is not None else DynamicCache(),
+            use_cache=True,
+            logits_to_keep=1
+        )
+        request.append(self._next_tokens(outputs.logits[:, -1, :], [request])[0])
+        self.generated_tokens += 1
+        self._merge(request, outputs.past_key_values)
+
+    def _merge(self, request: GenerationRequest, cache: DynamicCache) -> None:
+        new_length = cache.get_seq_length()
+        new_mask = torch.ones((1, new_length), dtype=torch.long, device=self.model.device)
+        if self.cache is None:
+            self.cache, self.attention_mask, self.running = cache, new_mask, [request]
+            return
+
+        # 左側 padding 對齊：每個 row 的最後一個 token 都在同一個 cache 位置
+        length = max(self.attention_mask.shape[1], new_length)
+        self.cache = DynamicCache([
+            (
+                torch.cat([_left_pad(batch_layer.keys, length), _left_pad(new_layer.keys, length)]),
+                torch.cat([_left_pad(batch_layer.values, length), _left_pad(new_layer.values, length)]),
+            )
+            for batch_layer, new_layer in zip(self.cache.layers, cache.layers)
+        ])
+        self.attention_mask = torch.cat([
+            F.pad(self.attention_mask, (length - self.attention_mask.shape[1], 0)),
+            F.pad(new_mask, (length - new_length, 0)),
+        ])
+        self.running.append(request)
+
+    def _decode_step(self) -> None:
+        device = self.model.device
+        input_ids = torch.tensor([[r.output_ids[-1]] for r in self.running], device=device)
+        position_ids = torch.tensor([[r.position] for r in self.running], device=device)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = outputs.past_key_values
+        for request, token in zip(self.running, self._next_tokens(outputs.logits[:, -1, :], self.running)):
+            request.append(token)
+        self.generated_tokens += len(self.running)
+
+    def _is_finished(self, request: GenerationRequest) -> bool:
+        return request.output_ids[-1] in self.eos_ids or len(request.output_ids) >= request.max_new_tokens \
+            or request.stopper.stop_reason is not None
+
+    def _retire(self) -> list[GenerationRequest]:
+        finished = [r for r in self.running if self._is_finished(r)]
+        if not finished:
+            return []
+
+        keep = [i for i, r in enumerate(self.running) if not self._is_finished(r)]
+        self.running = [self.running[i] for i in keep]
+        if not keep:
+            self.cache = self.attention_mask = None
+            return finished
+
+        keep_index = torch.tensor(keep, device=self.attention_mask.device)
+        self.cache.batch_select_indices(keep_index)
+        self.attention_mask = self.attention_mask[keep_index]
+
+        # 留下來的 row 都不需要的左側 padding 一起裁掉
+        leading_padding = int((self.attention_mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        if leading_padding:
+            self.cache = DynamicCache([
+                (layer.keys[:, :, leading_padding:], layer.values[:, :, leading_padding:])
+                for layer in self.cache.layers
+            ])
+            self.attention_mask = self.attention_mask[:, leading_padding:]
+        return finished
+
+    def _finish(self, request: GenerationRequest) -> None:
+        eos_reached = bool(request.output_ids) and request.output_ids[-1] in self.eos_ids
+        log_token_usage(request.stage, len(request.input_ids), request.stopper.usage(eos_reached=eos_reached))
+        if request.streamer is not None:
+            request.streamer.end()
+
+    def _completion(self, request: GenerationRequest) -> tuple:
+        output_ids = request.output_ids
+        eos_reached = bool(output_ids) and output_ids[-1] in self.eos_ids
+        if eos_reached:
+            output_ids = output_ids[:-1]
+        content, thinking_content = split_thinking(output_ids, self.tokenizer)
+        return request.request_id, content, thinking_content
+
+    @torch.no_grad()
+    def run(self) -> Iterator[tuple]:
+        # 依完成順序 yield (request_id, content, thinking_content)
+        while self.waiting or self.running:
+            start = time.perf_counter()
+            while self.waiting and len(self.running) < self.max_batch_size:
+                self._prefill(self.waiting.popleft())
+            finished = self._retire()
+            if self.running:
+                self._decode_step()
+                finished += self._retire()
+            self.busy_seconds += time.perf_counter() - start
+
+            for request in finished:
+                self._finish(request)
+                if request.stopper.stop_reason == "repetition" and request.retries:
+                    # 已經跑了一段的 request 排在最前面，不用等其他還沒開始的 request
+                    self.waiting.appendleft(self._retry(request))
+                    continue
+                if request.streamer is not None:
+                    request.streamer.record_timing()
+                print(datetime.datetime.now(), f"Request {request.request_id} completed.")
+                yield self._completion(request)
+
+    def tokens_per_second(self) -> float:
+        return self.generated_tokens / self.busy_seconds if self.busy_seconds else 0.0
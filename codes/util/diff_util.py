@@ -0,0 +1,53 @@
+import re
+from typing import List
+
+# @@ -old_start,old_len +new_start,new_len @@ section；資料集裡也有只寫 "@@" 的 hunk
+HUNK_HEADER = re.compile(r"^@@(?: -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@)?")
+
+
+def is_unified_diff(text: str) -> bool:
+    lines = text.splitlines()
+    has_file_header = any(line.startswith(("diff --git", "+++ ")) for line in lines)
+    return has_file_header and any(HUNK_HEADER.match(line) for line in lines)
+
+
+def parse_unified_diff(text: str) -> List[dict]:
+    # 每個 hunk 只保留新增的行（不含 header、context 與刪除的行），這才是要審查的程式碼
+    hunks = []
+    current_file = None
+    current = None
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        # 檔案標頭是成對的 "--- " / "+++ "，與 hunk 裡剛好以 -- / ++ 開頭的程式碼區分開
+        is_old_header = line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ ")
+        is_new_header = line.startswith("+++ ") and i > 0 and lines[i - 1].startswith("--- ")
+        if line.startswith("diff --git") or is_old_header:
+            current = None
+            continue
+        if is_new_header:
+            current = None
+            path = line[4:].strip()
+            current_file = path[2:] if path.startswith("b/") else path
+            continue
+
+        match = HUNK_HEADER.match(line)
+        if match:
+            current = {
+                "file": current_file,
+                "header": line,
+                "new_start": int(match.group(1)) if match.group(1) else None,
+                "added_lines": [],
+            }
+            hunks.append(current)
+        elif current is not None and line.startswith("+"):
+            current["added_lines"].append(line[1:])
+
+    return [
+        {
+            "file": h["file"],
+            "header": h["header"],
+            "new_start": h["new_start"],
+            "added": "\n".join(h["added_lines"]),
+        }
+        for h in hunks
+    ]
@@ -0,0 +1,259 @@
+import base64
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple
+
+import numpy as np
+
+# =========================
+# Service config
+# =========================
+# unix:/path/to.sock 或 tcp:127.0.0.1:8765；沒有 AF_UNIX 的平台預設用 localhost TCP
+DEFAULT_ADDRESS = "unix:/tmp/llm_research_rag.sock" if hasattr(socket, "AF_UNIX") else "tcp:127.0.0.1:8765"
+RAG_SERVICE_ADDRESS = os.getenv("RAG_SERVICE_ADDRESS", DEFAULT_ADDRESS)
+BATCH_WINDOW_MS = float(os.getenv("RAG_SERVICE_BATCH_WINDOW_MS", "10"))
+MAX_BATCH_REQUESTS = int(os.getenv("RAG_SERVICE_MAX_BATCH", "64"))
+CONNECT_TIMEOUT = 0.2
+
+
+def parse_address(address: str) -> Tuple[int, str | Tuple[str, int]]:
+    scheme, _, target = address.partition(":")
+    if scheme == "unix":
+        return socket.AF_UNIX, target
+    if scheme == "tcp":
+        host, _, port = target.rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Unknown service address: {address}")
+
+
+def encode_array(array: np.ndarray) -> dict:
+    array = np.ascontiguousarray(array, dtype="float32")
+    return {"shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode("ascii")}
+
+
+def decode_array(payload: dict) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(payload["data"]), dtype="float32").reshape(payload["shape"])
+
+# =========================
+# Micro-batching
+# =========================
+class MicroBatcher:
+    # 在很短的時間窗內收集同時到達的請求，合併成一次 embedding forward / 一次 index.search
+
+    def __init__(self, window_ms: float = BATCH_WINDOW_MS, max_requests: int = MAX_BATCH_REQUESTS):
+        self.window = window_ms / 1000
+        self.max_requests = max_requests
+        self.requests: queue.Queue = queue.Queue()
+        self.batches = 0
+        self.served = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, request: dict) -> Future:
+        future = Future()
+        self.requests.put((request, future))
+        return future
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_requests:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch: List[Tuple[dict, Future]]) -> None:
+        from codes.util import faiss_util
+
+        # 同樣參數的請求放在同一組，一組只跑一次
+        groups = {}
+        for request, future in batch:
+            if request.get("op") == "embed":
+                key = ("embed",)
+            elif request.get("op") == "search":
+                key = ("search", request.get("k", 15), request.get("threshold"), request.get("mode") or faiss_util.RETRIEVAL_MODE,
+                       request.get("chunked", False), json.dumps(request.get("category")),
+                       json.dumps(request.get("language")))
+            else:
+                future.set_result({"error": f"Unknown op: {request.get('op')}"})
+                continue
+            groups.setdefault(key, []).append((request, future))
+
+        for key, members in groups.items():
+            field = "texts" if key[0] == "embed" else "queries"
+            texts = [t for request, _ in members for t in request[field]]
+            try:
+                if key[0] == "embed":
+                    # 已在 rule index 裡的文字直接用建 index 時的向量，其餘才 embed
+                    outputs = list(faiss_util.get_rule_embeddings(texts)) if texts else []
+                else:
+                    _, k, threshold, mode, chunked, category, language = key
+                    category, language = json.loads(category), json.loads(language)
+                    # 與 ask_functions.search_rag_docs 相同：只有 dense 模式會切 window，hybrid / sparse 忽略 chunked
+                    if chunked and mode == "dense":
+                        outputs = [
+                            faiss_util.search_docs_chunked(t, k=k, threshold=threshold,
+                                                           category=category, language=language)
+                            for t in texts
+                        ]
+                    else:
+                        outputs = faiss_util.search_docs_hybrid_batch(
+                            texts, k=k, threshold=threshold, mode=mode, category=category, language=language
+                        )
+            except Exception as error:  # 把錯誤回給 client，服務本身不中斷
+                for _, future in members:
+                    future.set_result({"error": repr(error)})
+                continue
+
+            start = 0
+            for request, future in members:
+                part = outputs[start:start + len(request[field])]
+                start += len(request[field])
+                if key[0] == "embed":
+                    future.set_result({"embeddings": encode_array(np.array(part).reshape(len(part), -1))})
+                else:
+                    future.set_result({"results": [[docs, results] for docs, results in part]})
+
+        self.batches += 1
+        self.served += len(batch)
+
+# =========================
+# Server
+# =========================
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            request = json.loads(line)
+            if request.get("op") == "ping":
+                response = {"ok": True}
+            elif request.get("op") == "stats":
+                from codes.util.faiss_util import rag_cache_stats
+                response = {
+                    "batches": self.server.batcher.batches,
+                    "requests": self.server.batcher.served,
+                    "cache": rag_cache_stats(),
+                }
+            else:
+                response = self.server.batcher.submit(request).result()
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve(address: str = RAG_SERVICE_ADDRESS) -> None:
+    from codes.util.faiss_util import get_rule_index, load_embedding_model
+
+    family, target = parse_address(address)
+    if family != socket.AF_INET and os.path.exists(target):
+        # 還連得上表示已有 daemon 在跑，不能搶走它的 socket；連不上才是上次留下的 stale socket
+        if EmbeddingServiceClient(address).is_available():
+            raise RuntimeError(f"Embedding service already running on {address}")
+        os.unlink(target)
+
+    # 啟動時就載入模型與 index，之後的請求不用再等
+    load_embedding_model()
+    get_rule_index()
+
+    if family == socket.AF_INET:
+        server = socketserver.ThreadingTCPServer(target, _RequestHandler)
+    else:
+        server = socketserver.ThreadingUnixStreamServer(target, _RequestHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher()
+
+    print(f"[RAG] Embedding service listening on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family != socket.AF_INET and os.path.exists(target):
+            os.unlink(target)
+
+# =========================
+# Client
+# =========================
+class EmbeddingServiceClient:
+
+    def __init__(self, address: str = RAG_SERVICE_ADDRESS, timeout: float | None = None):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self, timeout: float | None) -> socket.socket:
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(target)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, payload: dict) -> dict:
+        with self._connect(self.timeout) as sock:
+            sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+            with sock.makefile("rb") as reader:
+                response = json.loads(reader.readline())
+        if "error" in response:
+            raise RuntimeError(f"Embedding service error: {response['error']}")
+        return response
+
+    def is_available(self) -> bool:
+        try:
+            with self._connect(CONNECT_TIMEOUT):
+                return True
+        except OSError:
+            return False
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return decode_array(self.request({"op": "embed", "texts": list(texts)})["embeddings"])
+
+    def search(
+        self,
+        queries: List[str],
+        k: int = 15,
+        threshold: float | None = None,
+        mode: str | None = None,
+        chunked: bool = False,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> List[Tuple[List[str], List[dict]]]:
+        if mode is None:
+            # 與 in-process 檢索相同的預設模式，開不開 daemon 檢索結果都一樣
+            from codes.util.faiss_util import RETRIEVAL_MODE
+            mode = RETRIEVAL_MODE
+        response = self.request({
+            "op": "search",
+            "queries": list(queries),
+            "k": k,
+            "threshold": threshold,
+            "mode": mode,
+            "chunked": chunked,
+            "category": category,
+            "language": language,
+        })
+        return [(docs, results) for docs, results in response["results"]]
+
+    def stats(self) -> dict:
+        return self.request({"op": "stats"})
+
+
+def get_client(address: str = RAG_SERVICE_ADDRESS) -> EmbeddingServiceClient | None:
+    # daemon 沒開時回傳 None，呼叫端改用 in-process 的 faiss_util
+    client = EmbeddingServiceClient(address)
+    return client if client.is_available() else None
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,208 @@
+import math
+import os
+
+import faiss
+import numpy as np
+
+# =========================
+# Index config
+# =========================
+# flat: 精確搜尋；hnsw / ivf_flat / ivf_pq: 規則庫變大時用的近似搜尋
+# sq8: 每維 int8 的 scalar quantizer；binary: 每維 1 bit 的 Hamming index
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "binary")
+RAG_INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "flat")
+
+HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "16"))
+PQ_NBITS = 8
+PQ_SUBVECTOR_DIM = 16
+
+# faiss k-means 建議每個 centroid 至少 39 個訓練點
+MIN_POINTS_PER_CENTROID = 39
+
+
+def index_settings(index_type: str = RAG_INDEX_TYPE) -> dict:
+    # 會影響 index 內容的設定，也是 index 快取檔名的一部分
+    settings = {"index_type": index_type}
+    if index_type == "hnsw":
+        settings.update(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION)
+    elif index_type == "ivf_pq":
+        settings.update(pq_nbits=PQ_NBITS, pq_subvector_dim=PQ_SUBVECTOR_DIM)
+    return settings
+
+
+def truncate_embeddings(embeddings: np.ndarray, dim: int | None) -> np.ndarray:
+    # Matryoshka：只保留前 dim 維再重新正規化，cosine 仍然成立
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if not dim or dim >= embeddings.shape[1]:
+        return embeddings
+    truncated = np.ascontiguousarray(embeddings[:, :dim])
+    faiss.normalize_L2(truncated)
+    return truncated
+
+
+class BinaryIPIndex:
+    # 把正規化向量的正負號壓成 bit，用 Hamming 距離搜尋；
+    # 分數以 SimHash 估計 cos(pi * hamming / dim)，與 cosine 同方向、可直接套 threshold
+
+    def __init__(self, dim: int, index=None, with_ids: bool = False):
+        self.d = dim
+        if index is None:
+            index = faiss.IndexBinaryFlat(((dim + 7) // 8) * 8)
+            if with_ids:
+                index = faiss.IndexBinaryIDMap2(index)
+        self.index = index
+        self.is_trained = True
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def _pack(self, x: np.ndarray) -> np.ndarray:
+        bits = np.zeros((x.shape[0], self.index.d), dtype=bool)
+        bits[:, :self.d] = x > 0
+        return np.packbits(bits, axis=1)
+
+    def _scores(self, distances: np.ndarray) -> np.ndarray:
+        hamming = np.minimum(distances.astype("float64"), self.d)
+        return np.cos(np.pi * hamming / self.d).astype("float32")
+
+    def train(self, x: np.ndarray) -> None:
+        pass
+
+    def add(self, x: np.ndarray) -> None:
+        self.index.add(self._pack(x))
+
+    def add_with_ids(self, x: np.ndarray, ids: np.ndarray) -> None:
+        self.index.add_with_ids(self._pack(x), ids)
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        return self.index.remove_ids(ids)
+
+    def search(self, x: np.ndarray, k: int):
+        distances, ids = self.index.search(self._pack(x), k)
+        scores = self._scores(distances)
+        scores[ids == -1] = -np.inf
+        return scores, ids
+
+    def range_search(self, x: np.ndarray, thresh: float):
+        # score > thresh 換算成 Hamming 距離上限（faiss binary range search 回傳 distance < radius）
+        max_hamming = self.d * np.arccos(np.clip(thresh, -1.0, 1.0)) / np.pi
+        radius = int(np.floor(max_hamming)) + 1
+        lims, distances, ids = self.index.range_search(self._pack(x), radius)
+        scores = self._scores(distances)
+        keep = scores > thresh
+        # 過濾後依累計數量重新換算每個 query 的 lims
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+        return kept_before[lims.astype("int64")], scores[keep], ids[keep]
+
+
+def write_index(index, path: str) -> None:
+    if isinstance(index, BinaryIPIndex):
+        faiss.write_index_binary(index.index, path)
+    else:
+        faiss.write_index(index, path)
+
+
+def read_index(path: str, index_type: str, dim: int, mmap: bool = True):
+    if index_type == "binary":
+        return BinaryIPIndex(dim, faiss.read_index_binary(path))
+    # IVF 的 mmap 會變成唯讀的 OnDiskInvertedLists，之後 add_rules 無法新增，一律讀進記憶體
+    if mmap and index_type not in ("ivf_flat", "ivf_pq"):
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            # 不支援 mmap 的 index 類型就直接讀進記憶體
+            pass
+    return faiss.read_index(path)
+
+
+def index_nbytes(index) -> int:
+    if isinstance(index, BinaryIPIndex):
+        return len(faiss.serialize_index_binary(index.index))
+    return len(faiss.serialize_index(index))
+
+
+def default_nlist(n: int) -> int:
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_CENTROID))
+
+
+def default_pq_m(dim: int) -> int:
+    # PQ 的子向量數必須整除維度
+    m = max(1, dim // PQ_SUBVECTOR_DIM)
+    while dim % m != 0:
+        m -= 1
+    return m
+
+
+def configure_search(index, ef_search: int = HNSW_EF_SEARCH, nprobe: int = IVF_NPROBE) -> None:
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(nprobe, index.nlist)
+
+
+def build_faiss_index(embeddings: np.ndarray, index_type: str = RAG_INDEX_TYPE, ids: np.ndarray | None = None):
+    # 給 ids 時 index 回傳的是這些穩定 id（而不是位置），之後可以用 id 增刪
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    n, dim = embeddings.shape
+
+    if index_type in ("ivf_flat", "ivf_pq") and n < MIN_POINTS_PER_CENTROID:
+        print(f"[RAG] Only {n} docs, too few to train {index_type}; falling back to flat")
+        index_type = "flat"
+    if index_type == "ivf_pq" and n < 2 ** PQ_NBITS:
+        print(f"[RAG] Only {n} docs, too few to train PQ codebooks; falling back to ivf_flat")
+        index_type = "ivf_flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "binary":
+        index = BinaryIPIndex(dim, with_ids=ids is not None)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    else:
+        nlist = default_nlist(n)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, default_pq_m(dim), PQ_NBITS,
+                                     faiss.METRIC_INNER_PRODUCT)
+        # quantizer 要跟著 index 一起活著，避免被 GC 回收
+        index.own_fields = True
+        quantizer.this.disown()
+
+    if ids is not None and not isinstance(index, (faiss.IndexIVF, BinaryIPIndex)):
+        # IVF 本身就存 id，其餘類型用 IndexIDMap2 包一層
+        index = faiss.IndexIDMap2(index)
+
+    if not index.is_trained:
+        index.train(embeddings)
+    if ids is not None:
+        index.add_with_ids(embeddings, np.asarray(ids, dtype="int64"))
+    else:
+        index.add(embeddings)
+    configure_search(index)
+    return index
+
+
+def index_to_gpu(cpu_index):
+    if isinstance(cpu_index, BinaryIPIndex):
+        return cpu_index
+    try:
+        res = faiss.StandardGpuResources()
+        return faiss.index_cpu_to_gpu(res, 0, cpu_index)
+    except (AttributeError, RuntimeError) as error:
+        # HNSW 等沒有 GPU 實作的 index 留在 CPU
+        print(f"[RAG] Keeping index on CPU: {error}")
+        return cpu_index
@@ -1,4 +1,6 @@
+import json
 import os
+from contextlib import nullcontext
 from typing import List, Tuple
 
 import faiss
@@ -6,7 +8,12 @@ import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModel
 
-from datas.RAG_data.rag_data import rule_docs
+from codes.util.bm25_util import BM25Index, reciprocal_rank_fusion
+from codes.util.faiss_index_util import (
+    RAG_INDEX_TYPE, build_faiss_index, configure_search, index_settings, index_to_gpu, truncate_embeddings
+)
+from codes.util.rag_cache import EmbeddingCache, LRUCache, USE_RAG_CACHE, settings_hash, text_hash
+from datas.RAG_data.rag_data import rule_records
 
 # =========================
 # Env config
@@ -18,68 +25,700 @@ USE_GPU = USE_FAISS_GPU and TORCH_USE_CUDA
 
 DEVICE = "cuda" if USE_GPU else "cpu"
 MODEL_NAME = "Qwen/Qwen3-Embedding-4B"
+MAX_LENGTH = 2048
+POOLING = "mean"
+# Matryoshka 截斷維度，0 代表使用模型完整輸出維度
+EMBEDDING_DIM = int(os.getenv("RAG_EMBEDDING_DIM", "0"))
+MAX_TOKENS_PER_BATCH = int(os.getenv("RAG_MAX_TOKENS_PER_BATCH", "16384"))
+CHUNK_WINDOW = 512
+CHUNK_STRIDE = 384
+
+# dense: 只用 embedding；hybrid: BM25 + embedding 做 RRF；sparse: 只用 BM25，不載入 embedding model
+RETRIEVAL_MODES = ("dense", "hybrid", "sparse")
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "dense")
+
+# dedicated: 獨立載入 Qwen3-Embedding-4B
+# generation: 借用已載入的生成模型（關閉 LoRA adapter）的 hidden states，節點上只需常駐一個模型
+EMBEDDING_BACKENDS = ("dedicated", "generation")
+EMBEDDING_BACKEND = os.getenv("RAG_EMBEDDING_BACKEND", "dedicated")
 
-print(f"[RAG] FAISS GPU = {USE_FAISS_GPU}, torch cuda = {TORCH_USE_CUDA}")
-print(f"[RAG] Using device: {DEVICE}")
+
+def embedding_settings() -> dict:
+    # 會影響向量內容的設定，也是磁碟快取的 key
+    return {
+        "backend": EMBEDDING_BACKEND,
+        "model_name": emb_model_name,
+        "pooling": POOLING,
+        "normalize": "l2",
+        "max_length": MAX_LENGTH,
+        "dim": EMBEDDING_DIM,
+    }
 
 # =========================
-# Load embedding model
+# Load embedding model (lazy)
 # =========================
-emb_tokenizer = AutoTokenizer.from_pretrained(
-    MODEL_NAME,
-    trust_remote_code=True
-)
+# 模型只在第一次需要 embedding 時才載入，import 本模組不再有任何成本
+emb_tokenizer = None
+emb_model = None
+emb_model_name = MODEL_NAME
+
+
+def load_embedding_model():
+    global emb_tokenizer, emb_model
+    if emb_model is None:
+        if EMBEDDING_BACKEND == "generation":
+            raise RuntimeError(
+                "RAG_EMBEDDING_BACKEND=generation but no generation model is registered; "
+                "call use_generation_model_embeddings(model, tokenizer) after loading it"
+            )
+        print(f"[RAG] FAISS GPU = {USE_FAISS_GPU}, torch cuda = {TORCH_USE_CUDA}")
+        print(f"[RAG] Using device: {DEVICE}")
+
+        emb_tokenizer = AutoTokenizer.from_pretrained(
+            MODEL_NAME,
+            trust_remote_code=True
+        )
+
+        emb_model = AutoModel.from_pretrained(
+            MODEL_NAME,
+            trust_remote_code=True
+        ).to(DEVICE)
+        emb_model.eval()
+    return emb_tokenizer, emb_model
 
-emb_model = AutoModel.from_pretrained(
-    MODEL_NAME,
-    trust_remote_code=True
-).to(DEVICE)
-emb_model.eval()
+
+def use_generation_model_embeddings(model, tokenizer) -> None:
+    # 改用生成模型當 embedder；向量空間不同，快取 key 與預設 rule index 都要換掉
+    global EMBEDDING_BACKEND, emb_tokenizer, emb_model, emb_model_name, _rule_index
+    EMBEDDING_BACKEND = "generation"
+    emb_tokenizer, emb_model = tokenizer, model
+    emb_model_name = getattr(model.config, "_name_or_path", "") or type(model).__name__
+    _rule_index = None
+    print(f"[RAG] Using hidden states of {emb_model_name} as embeddings")
+
+
+def _last_hidden_state(model, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    if EMBEDDING_BACKEND != "generation":
+        return model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    # PeftModel 先關掉 adapter，只用 base 權重；只跑 decoder，不計算整個詞表的 logits
+    adapters_off = model.disable_adapter() if hasattr(model, "disable_adapter") else nullcontext()
+    with adapters_off:
+        return model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
 
 # =========================
 # Embedding function
 # =========================
+def _token_budget_batches(lengths: List[int], max_tokens_per_batch: int) -> List[List[int]]:
+    # 依長度由長到短排序後打包，每個 batch 的 padding 後大小 (筆數 x 最長長度) 不超過 token 預算
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current = []
+    for i in order:
+        if current and (len(current) + 1) * lengths[current[0]] > max_tokens_per_batch:
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
 @torch.no_grad()
-def get_embedding(text: str) -> np.ndarray:
-    inputs = emb_tokenizer(
-        text,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=2048
-    ).to(DEVICE)
+def embed_token_ids(
+    token_ids: List[List[int]],
+    max_tokens_per_batch: int = MAX_TOKENS_PER_BATCH
+) -> np.ndarray:
+    tokenizer, model = load_embedding_model()
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
 
-    outputs = emb_model(**inputs)
-    last_hidden = outputs.last_hidden_state
-    attention_mask = inputs["attention_mask"].unsqueeze(-1)
+    lengths = [len(ids) for ids in token_ids]
+    pooled_rows = [None] * len(token_ids)
+    for batch in _token_budget_batches(lengths, max_tokens_per_batch):
+        max_len = lengths[batch[0]]
+        # 右側 padding：causal model 的有效 token 看不到後面的 pad，結果與 batch size 1 相同
+        input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for row, i in enumerate(batch):
+            input_ids[row, :lengths[i]] = torch.tensor(token_ids[i], dtype=torch.long)
+            attention_mask[row, :lengths[i]] = 1
+        input_ids = input_ids.to(model.device)
+        attention_mask = attention_mask.to(model.device)
 
-    pooled = (last_hidden * attention_mask).sum(dim=1) / attention_mask.sum(dim=1)
-    emb = pooled[0].float().cpu().numpy().astype("float32")
+        last_hidden = _last_hidden_state(model, input_ids, attention_mask)
+        mask = attention_mask.unsqueeze(-1).to(last_hidden.dtype)
+
+        pooled = (last_hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        pooled = pooled.float().cpu().numpy()
+        for row, i in enumerate(batch):
+            pooled_rows[i] = pooled[row]
+
+    embeddings = np.ascontiguousarray(np.stack(pooled_rows), dtype="float32")
+
+    # cosine similarity：一次正規化所有向量
+    faiss.normalize_L2(embeddings)
+    return truncate_embeddings(embeddings, EMBEDDING_DIM)
+
+
+def get_embeddings(
+    texts: List[str],
+    max_tokens_per_batch: int = MAX_TOKENS_PER_BATCH
+) -> np.ndarray:
+    tokenizer, _ = load_embedding_model()
+    token_ids = tokenizer(
+        list(texts),
+        truncation=True,
+        max_length=MAX_LENGTH
+    )["input_ids"]
+    return embed_token_ids(token_ids, max_tokens_per_batch=max_tokens_per_batch)
 
-    # cosine similarity
-    faiss.normalize_L2(emb.reshape(1, -1))
-    return emb
 
 # =========================
-# Build FAISS index
+# Query memoisation
 # =========================
-dim = get_embedding("test").shape[0]
+_embedding_memo = LRUCache("embedding")
+_search_memo = LRUCache("search")
+
+
+def _embedding_memo_key(text: str) -> str:
+    return f"{settings_hash(embedding_settings())}:{text_hash(text)}"
+
+
+def get_query_embeddings(texts: List[str]) -> np.ndarray:
+    # 已經算過的 query 直接從 LRU 取，剩下的一次 batch embed
+    rows = [_embedding_memo.get(_embedding_memo_key(t)) for t in texts]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        new_embeddings = get_embeddings([texts[i] for i in missing])
+        for i, emb in zip(missing, new_embeddings):
+            rows[i] = emb
+            _embedding_memo.put(_embedding_memo_key(texts[i]), emb)
+    return np.stack(rows).astype("float32")
+
+
+def get_embedding(text: str) -> np.ndarray:
+    return get_query_embeddings([text])[0]
+
+
+def _special_token_affixes(tokenizer) -> Tuple[List[int], List[int]]:
+    # 找出 tokenizer 自動加在前後的 special tokens，讓每個 window 的格式與一般輸入一致
+    with_special = tokenizer("x")["input_ids"]
+    without_special = tokenizer("x", add_special_tokens=False)["input_ids"]
+    for start in range(len(with_special) - len(without_special) + 1):
+        if with_special[start:start + len(without_special)] == without_special:
+            return with_special[:start], with_special[start + len(without_special):]
+    return [], []
+
 
-cpu_index = faiss.IndexFlatIP(dim)
+def chunk_token_ids(text: str, window: int = CHUNK_WINDOW, stride: int = CHUNK_STRIDE) -> List[List[int]]:
+    # 長程式碼切成互相重疊的 window，不再被 MAX_LENGTH 截斷
+    tokenizer, _ = load_embedding_model()
+    prefix, suffix = _special_token_affixes(tokenizer)
+    window = min(window, MAX_LENGTH - len(prefix) - len(suffix))
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
 
-if USE_GPU:
-    res = faiss.StandardGpuResources()
-    index = faiss.index_cpu_to_gpu(res, 0, cpu_index)
-else:
-    index = cpu_index
+    starts = list(range(0, max(len(ids) - window, 0) + 1, stride))
+    if starts[-1] + window < len(ids):
+        starts.append(len(ids) - window)
+    return [prefix + ids[start:start + window] + suffix for start in starts]
+
+
+def get_chunk_embeddings(text: str, window: int = CHUNK_WINDOW, stride: int = CHUNK_STRIDE) -> np.ndarray:
+    # 所有 window 一起 batch embed，attention 成本隨檔案長度線性成長
+    return embed_token_ids(chunk_token_ids(text, window=window, stride=stride))
+
+
+def rag_cache_stats() -> dict:
+    return {
+        "embedding": _embedding_memo.stats(),
+        "search": _search_memo.stats(),
+    }
+
+
+def clear_rag_caches() -> None:
+    _embedding_memo.clear()
+    _search_memo.clear()
 
 # =========================
-# Ingest documents
+# Rule index
 # =========================
-doc_embeddings = np.stack([get_embedding(d) for d in rule_docs])
-index.add(doc_embeddings)
+def _embedding_dim(cached: dict, new_embeddings: np.ndarray | None) -> int:
+    if new_embeddings is not None:
+        return new_embeddings.shape[1]
+    return next(iter(cached.values())).shape[0]
+
+
+def rule_id(key: str) -> int:
+    # 由內容 hash 推得的穩定 rule id（60 bits，放得進 faiss 的 int64）
+    return int(key[:15], 16)
+
+
+UNCATEGORIZED = "Uncategorized"
+
+
+def as_rule_records(rules: List[str | dict]) -> List[dict]:
+    # rule 可以是純文字或 rag_data.rule_records 的 dict；相同內容只保留第一份，id 才會唯一
+    records = {}
+    for rule in rules:
+        if isinstance(rule, str):
+            rule = {"text": rule}
+        records.setdefault(rule["text"], {
+            "category": rule.get("category", UNCATEGORIZED),
+            "language": rule.get("language", "any"),
+            "text": rule["text"],
+        })
+    return list(records.values())
+
+
+def _as_set(value: str | List[str] | None) -> set | None:
+    if value is None:
+        return None
+    return {value} if isinstance(value, str) else set(value)
+
+
+def filter_mask(
+    metadata: List[dict],
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> np.ndarray:
+    # language 為 "any" 的 rule 適用所有語言
+    categories = _as_set(category)
+    languages = _as_set(language)
+    mask = np.ones(len(metadata), dtype=bool)
+    if categories is not None:
+        mask &= np.array([m["category"] in categories for m in metadata], dtype=bool)
+    if languages is not None:
+        languages.add("any")
+        mask &= np.array([m["language"] in languages for m in metadata], dtype=bool)
+    return mask
+
+
+class RuleIndex:
+
+    def __init__(
+        self,
+        docs: List[str],
+        index,
+        embeddings: np.ndarray = None,
+        index_type: str = RAG_INDEX_TYPE,
+        cache: EmbeddingCache | None = None,
+        metadata: List[dict] = None
+    ):
+        self.docs = docs
+        self.metadata = metadata if metadata is not None else [
+            {"category": UNCATEGORIZED, "language": "any"} for _ in docs
+        ]
+        self.cpu_index = index
+        self.index = index_to_gpu(index) if USE_GPU else index
+        self.embeddings = embeddings
+        self.index_type = index_type
+        self.cache = cache
+        self._refresh()
+
+    def _refresh(self) -> None:
+        self.keys = [text_hash(d) for d in self.docs]
+        self.ids = np.array([rule_id(key) for key in self.keys], dtype="int64")
+        self._positions = {int(i): pos for pos, i in enumerate(self.ids)}
+        # rule 內容或 metadata 改變時 fingerprint 也會變，舊的檢索快取自然失效
+        self.fingerprint = text_hash(
+            settings_hash(embedding_settings()) + "".join(self.keys) + json.dumps(self.metadata, sort_keys=True)
+        )
+        # 依 (category, language) 分區的子 index，第一次被篩選到時才由現有向量建立
+        self._shards = {}
+
+    @classmethod
+    def build(
+        cls,
+        docs: List[str | dict] = None,
+        use_cache: bool = USE_RAG_CACHE,
+        index_type: str = RAG_INDEX_TYPE
+    ) -> "RuleIndex":
+        records = as_rule_records(rule_records if docs is None else docs)
+        docs = [r["text"] for r in records]
+        metadata = [{"category": r["category"], "language": r["language"]} for r in records]
+        keys = [text_hash(d) for d in docs]
+        ids = np.array([rule_id(key) for key in keys], dtype="int64")
+        cache = EmbeddingCache(embedding_settings()) if use_cache else None
+
+        if cache is not None and cache.has_index(keys, index_settings(index_type)):
+            # Warm start: 直接讀取快取的 index（IVF 以外 mmap），完全不需要 embed 文件
+            doc_embeddings = cache.load_embeddings()
+            cpu_index = cache.read_index(keys, index_settings(index_type), doc_embeddings.shape[1])
+            configure_search(cpu_index)
+            print(f"[RAG] Loaded cached FAISS index from {cache.path}")
+        else:
+            # Ingest documents，只 embed 快取中沒有的（新增或修改過的）rule
+            cached = cache.lookup(keys) if cache is not None else {}
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+            new_embeddings = get_embeddings([docs[i] for i in missing]) if missing else None
+
+            doc_embeddings = np.empty((len(docs), _embedding_dim(cached, new_embeddings)), dtype="float32")
+            for i, key in enumerate(keys):
+                if key in cached:
+                    doc_embeddings[i] = cached[key]
+            if missing:
+                doc_embeddings[missing] = new_embeddings
+            print(f"[RAG] Embedded {len(docs) - len(cached)} docs, reused {len(cached)} from cache")
+
+            cpu_index = build_faiss_index(doc_embeddings, index_type=index_type, ids=ids)
+            if cache is not None:
+                cache.save(keys, doc_embeddings, cpu_index, index_settings(index_type))
+
+        rule_index = cls(docs, cpu_index, doc_embeddings, index_type=index_type, cache=cache, metadata=metadata)
+        print(f"[RAG] FAISS index ready ({index_type}), total docs = {rule_index.ntotal}")
+        return rule_index
+
+    # =========================
+    # Incremental updates
+    # =========================
+    # 磁碟快取只追加新 rule 的向量；刪除不寫檔，快取中多出的向量不影響 lookup，
+    # 下次 build 時由快取向量重建 index 並整理成與 rule 清單一致
+    def _commit(self) -> None:
+        self._refresh()
+        self.index = index_to_gpu(self.cpu_index) if USE_GPU else self.cpu_index
+
+    def add_rules(self, rules: List[str | dict]) -> List[int]:
+        # 只 embed 真的是新的 rule，已存在的內容直接略過
+        new_records = [r for r in as_rule_records(rules) if rule_id(text_hash(r["text"])) not in self._positions]
+        if not new_records:
+            return []
+        new_texts = [r["text"] for r in new_records]
+
+        new_embeddings = get_embeddings(new_texts)
+        new_ids = np.array([rule_id(text_hash(t)) for t in new_texts], dtype="int64")
+        embeddings = np.vstack([np.asarray(self.embeddings), new_embeddings])
+        try:
+            self.cpu_index.add_with_ids(new_embeddings, new_ids)
+        except RuntimeError:
+            # 唯讀（mmap）的 index 不能新增：與 remove_rules 相同，用記憶體裡的向量重建，不需要重新 embed
+            self.cpu_index = build_faiss_index(embeddings, index_type=self.index_type,
+                                               ids=np.concatenate([self.ids, new_ids]))
+
+        self.docs = self.docs + new_texts
+        self.metadata = self.metadata + [{"category": r["category"], "language": r["language"]} for r in new_records]
+        self.embeddings = embeddings
+        self._commit()
+        if self.cache is not None:
+            self.cache.append([text_hash(t) for t in new_texts], new_embeddings)
+        return new_ids.tolist()
+
+    def remove_rules(self, rules: List[str | int]) -> List[int]:
+        # rules 可以是 rule 內容，也可以是 rule id
+        remove_ids = {r if isinstance(r, int) else rule_id(text_hash(r)) for r in rules}
+        remove_ids &= set(self._positions)
+        if not remove_ids:
+            return []
+
+        keep = np.array([int(i) not in remove_ids for i in self.ids])
+        self.docs = [d for d, k in zip(self.docs, keep) if k]
+        self.metadata = [m for m, k in zip(self.metadata, keep) if k]
+        self.embeddings = np.asarray(self.embeddings)[keep]
+        try:
+            self.cpu_index.remove_ids(np.array(sorted(remove_ids), dtype="int64"))
+        except RuntimeError:
+            # HNSW 等不支援刪除的 index：用留在記憶體的向量重建，不需要重新 embed
+            self.cpu_index = build_faiss_index(self.embeddings, index_type=self.index_type, ids=self.ids[keep])
+        self._commit()
+        return sorted(remove_ids)
+
+    def update_rule(self, old: str | int, new: str | dict) -> List[int]:
+        self.remove_rules([old])
+        return self.add_rules([new])
 
-print(f"[RAG] FAISS index ready, total docs = {index.ntotal}")
+    def sync_rules(self, docs: List[str | dict]) -> Tuple[List[int], List[int]]:
+        # 與新的 rule 清單比對，只處理差異；回傳 (新增的 id, 刪除的 id)
+        records = as_rule_records(docs)
+        wanted = {rule_id(text_hash(r["text"])) for r in records}
+        removed = self.remove_rules([int(i) for i in self.ids if int(i) not in wanted])
+        added = self.add_rules(records)
+
+        # 內容沒變、只改了 category / language 的 rule 不需要重新 embed
+        metadata = list(self.metadata)
+        for r in records:
+            pos = self._positions[rule_id(text_hash(r["text"]))]
+            metadata[pos] = {"category": r["category"], "language": r["language"]}
+        if metadata != self.metadata:
+            self.metadata = metadata
+            self._refresh()
+        return added, removed
+
+    def positions(self, ids: np.ndarray) -> np.ndarray:
+        # faiss 回傳的 rule id 轉回 docs / embeddings 的位置，-1 保持 -1
+        return np.array([self._positions.get(int(i), -1) for i in np.ravel(ids)], dtype="int64").reshape(np.shape(ids))
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    # =========================
+    # Category / language shards
+    # =========================
+    def _shard(self, key: Tuple[str, str]):
+        if key not in self._shards:
+            positions = np.array([
+                pos for pos, m in enumerate(self.metadata) if (m["category"], m["language"]) == key
+            ], dtype="int64")
+            self._shards[key] = build_faiss_index(
+                np.asarray(self.embeddings)[positions],
+                index_type=self.index_type,
+                ids=self.ids[positions]
+            )
+        return self._shards[key]
+
+    def _matching_shard_keys(
+        self,
+        category: str | List[str] | None,
+        language: str | List[str] | None
+    ) -> List[Tuple[str, str]]:
+        mask = filter_mask(self.metadata, category, language)
+        return sorted({(m["category"], m["language"]) for m, keep in zip(self.metadata, mask) if keep})
+
+    def search_ids(
+        self,
+        q_emb: np.ndarray,
+        k: int,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # 回傳 (scores, rule ids)；有篩選條件時只搜尋符合的分區，再合併各分區的 top-k
+        if category is None and language is None:
+            return self.index.search(q_emb, k)
+
+        shard_keys = self._matching_shard_keys(category, language)
+        if not shard_keys:
+            return (np.full((q_emb.shape[0], k), -np.inf, dtype="float32"),
+                    np.full((q_emb.shape[0], k), -1, dtype="int64"))
+
+        parts = [self._shard(key).search(q_emb, k) for key in shard_keys]
+        scores = np.hstack([p[0] for p in parts])
+        ids = np.hstack([p[1] for p in parts])
+        scores[ids == -1] = -np.inf
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def _collect_results(
+        self,
+        scores: np.ndarray,
+        indices: np.ndarray,
+        threshold: float | None
+    ) -> List[Tuple[List[str], List[dict]]]:
+        # 一次用 NumPy mask 過濾所有 query 的 -1 與低於 threshold 的結果
+        keep = indices != -1
+        if threshold is not None:
+            keep &= scores >= threshold
+
+        positions = self.positions(indices)
+        batch_results = []
+        for row_scores, row_positions, row_keep in zip(scores, positions, keep):
+            results = [
+                {"doc": self.docs[pos], "score": score}
+                for pos, score in zip(row_positions[row_keep].tolist(), row_scores[row_keep].tolist())
+            ]
+            batch_results.append(([r["doc"] for r in results], results))
+        return batch_results
+
+    def docs_for(self, ids: np.ndarray) -> List[str]:
+        return [self.docs[pos] for pos in self.positions(ids).tolist()]
+
+    # =========================
+    # Threshold-first range search
+    # =========================
+    def range_search_ids(
+        self,
+        q_emb: np.ndarray,
+        threshold: float,
+        max_results: int | None = None,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # 每個 query 回傳 (rule ids, scores)，只含 score >= threshold，依分數由高到低，最多 max_results 筆
+        if category is None and language is None:
+            indexes = [self.cpu_index]
+        else:
+            indexes = [self._shard(key) for key in self._matching_shard_keys(category, language)]
+
+        # faiss 的 IP range search 只回傳 score > radius，往下退一個 float 讓等於 threshold 的也算進去
+        radius = float(np.nextafter(np.float32(threshold), np.float32(-np.inf)))
+        id_parts = [[] for _ in range(q_emb.shape[0])]
+        score_parts = [[] for _ in range(q_emb.shape[0])]
+        for index in indexes:
+            lims, scores, ids = index.range_search(q_emb, radius)
+            for row in range(q_emb.shape[0]):
+                id_parts[row].append(ids[lims[row]:lims[row + 1]])
+                score_parts[row].append(scores[lims[row]:lims[row + 1]])
+
+        results = []
+        for row_ids, row_scores in zip(id_parts, score_parts):
+            ids = np.concatenate(row_ids) if row_ids else np.empty(0, dtype="int64")
+            scores = np.concatenate(row_scores) if row_scores else np.empty(0, dtype="float32")
+            order = np.argsort(-scores, kind="stable")[:max_results]
+            results.append((ids[order], scores[order]))
+        return results
+
+    def search_range_batch(
+        self,
+        queries: List[str],
+        threshold: float,
+        max_results: int | None = None,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if not queries:
+            return []
+        return self.range_search_ids(
+            get_query_embeddings(queries), threshold, max_results=max_results, category=category, language=language
+        )
+
+    def search_range(
+        self,
+        query: str,
+        threshold: float,
+        max_results: int | None = None,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> Tuple[List[str], List[dict]]:
+        # 與 search 相同的 (docs, results) 格式
+        ids, scores = self.search_range_batch(
+            [query], threshold, max_results=max_results, category=category, language=language
+        )[0]
+        results = [{"doc": doc, "score": score} for doc, score in zip(self.docs_for(ids), scores.tolist())]
+        return [r["doc"] for r in results], results
+
+    def _search_memo_key(
+        self,
+        query: str,
+        k: int,
+        threshold: float | None,
+        mode: str = "dense",
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> str:
+        return (f"{self.fingerprint}:{text_hash(query)}:k={k}:threshold={threshold}:mode={mode}"
+                f":category={category}:language={language}")
+
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = 15,
+        threshold: float | None = None,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> List[Tuple[List[str], List[dict]]]:
+        memo_keys = [
+            self._search_memo_key(q, k, threshold, category=category, language=language)
+            for q in queries
+        ]
+        batch_results = [_search_memo.get(key) for key in memo_keys]
+        missing = [i for i, r in enumerate(batch_results) if r is None]
+
+        if missing:
+            q_emb = get_query_embeddings([queries[i] for i in missing])
+
+            scores, indices = self.search_ids(q_emb, k, category=category, language=language)
+            for i, result in zip(missing, self._collect_results(scores, indices, threshold)):
+                batch_results[i] = result
+                _search_memo.put(memo_keys[i], result)
+
+        # 回傳複本，避免呼叫端修改到快取內容
+        return [(list(docs), [dict(r) for r in results]) for docs, results in batch_results]
+
+    def search(
+        self,
+        query: str,
+        k: int = 15,
+        threshold: float | None = None,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> Tuple[List[str], List[dict]]:
+        return self.search_batch([query], k=k, threshold=threshold, category=category, language=language)[0]
+
+    def doc_vectors(self, ids: np.ndarray) -> np.ndarray:
+        if self.embeddings is not None:
+            return np.asarray(self.embeddings[self.positions(ids)], dtype="float32")
+        return np.stack([self.cpu_index.reconstruct(int(i)) for i in ids])
+
+    def search_chunked(
+        self,
+        query: str,
+        k: int = 15,
+        threshold: float | None = None,
+        merge: str = "max",
+        window: int = CHUNK_WINDOW,
+        stride: int = CHUNK_STRIDE,
+        category: str | List[str] | None = None,
+        language: str | List[str] | None = None
+    ) -> Tuple[List[str], List[dict]]:
+        if merge not in ("max", "mean"):
+            raise ValueError(f"Unknown merge mode: {merge}")
+
+        memo_key = self._search_memo_key(
+            query, k, threshold, mode=f"chunked-{merge}-{window}-{stride}", category=category, language=language
+        )
+        cached = _search_memo.get(memo_key)
+        if cached is None:
+            window_emb = get_chunk_embeddings(query, window=window, stride=stride)
+
+            # 每個 window 的 top-k 聯集當候選，再精確算出所有 window 對候選的分數
+            _, indices = self.search_ids(window_emb, k, category=category, language=language)
+            candidates = np.unique(indices[indices != -1])
+            window_scores = window_emb @ self.doc_vectors(candidates).T
+            merged = window_scores.max(axis=0) if merge == "max" else window_scores.mean(axis=0)
+
+            order = np.argsort(-merged)[:k]
+            cached = self._collect_results(
+                merged[order].reshape(1, -1),
+                candidates[order].reshape(1, -1),
+                threshold
+            )[0]
+            _search_memo.put(memo_key, cached)
+
+        docs, results = cached
+        return list(docs), [dict(r) for r in results]
+
+
+_rule_index: RuleIndex | None = None
+_bm25_index: BM25Index | None = None
+_bm25_metadata: List[dict] = []
+
+
+def build_rule_index(
+    docs: List[str | dict] = None,
+    use_cache: bool = USE_RAG_CACHE,
+    index_type: str = RAG_INDEX_TYPE
+) -> RuleIndex:
+    # 明確建立（或重建）預設的 rule index
+    global _rule_index, _bm25_index
+    _rule_index = RuleIndex.build(docs, use_cache=use_cache, index_type=index_type)
+    _bm25_index = None
+    return _rule_index
+
+
+def get_rule_index() -> RuleIndex:
+    if _rule_index is None:
+        return build_rule_index()
+    return _rule_index
+
+def build_bm25_index() -> BM25Index:
+    # 明確重建 BM25 index；只用 sparse 檢索時不會建 dense index，也不會載入 embedding model
+    global _bm25_index
+    _bm25_index = None
+    return get_bm25_index()
+
+
+def get_bm25_index() -> BM25Index:
+    # BM25 與 dense index 使用同一份 docs，id 才能對齊做 fusion
+    # 增刪 rule 後 RuleIndex.docs 會換成新的 list，BM25 也跟著重建
+    global _bm25_index, _bm25_metadata
+    if _bm25_index is None or (_rule_index is not None and _bm25_index.docs is not _rule_index.docs):
+        if _rule_index is not None:
+            _bm25_index = BM25Index(_rule_index.docs)
+        else:
+            records = as_rule_records(rule_records)
+            _bm25_index = BM25Index([r["text"] for r in records])
+            _bm25_metadata = [{"category": r["category"], "language": r["language"]} for r in records]
+    if _rule_index is not None:
+        _bm25_metadata = _rule_index.metadata
+    return _bm25_index
 
 # =========================
 # Query
@@ -87,22 +726,148 @@ print(f"[RAG] FAISS index ready, total docs = {index.ntotal}")
 def search_docs(
     query: str,
     k: int = 15,
-    threshold: float | None = None
+    threshold: float | None = None,
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
 ) -> Tuple[List[str], List[dict]]:
-    q_emb = get_embedding(query).reshape(1, -1)
+    return get_rule_index().search(query, k=k, threshold=threshold, category=category, language=language)
 
-    scores, indices = index.search(q_emb, k)
 
-    results = []
-    for score, idx in zip(scores[0], indices[0]):
-        if idx == -1:
-            continue
-        if threshold is not None and score < threshold:
-            continue
+def search_docs_batch(
+    queries: List[str],
+    k: int = 15,
+    threshold: float | None = None,
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> List[Tuple[List[str], List[dict]]]:
+    return get_rule_index().search_batch(queries, k=k, threshold=threshold, category=category, language=language)
 
-        results.append({
-            "doc": rule_docs[idx],
-            "score": float(score)
-        })
 
-    return [r["doc"] for r in results], results
+def search_docs_chunked(
+    query: str,
+    k: int = 15,
+    threshold: float | None = None,
+    merge: str = "max",
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> Tuple[List[str], List[dict]]:
+    return get_rule_index().search_chunked(
+        query, k=k, threshold=threshold, merge=merge, category=category, language=language
+    )
+
+
+def search_docs_hybrid_batch(
+    queries: List[str],
+    k: int = 15,
+    threshold: float | None = None,
+    mode: str = "hybrid",
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> List[Tuple[List[str], List[dict]]]:
+    # threshold 只套用在 dense 的 cosine 分數上；BM25 只保留分數 > 0 的結果
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}, expected one of {RETRIEVAL_MODES}")
+    if mode == "dense":
+        return search_docs_batch(queries, k=k, threshold=threshold, category=category, language=language)
+    if not queries:
+        return []
+
+    bm25 = get_bm25_index()
+    mask = None
+    if category is not None or language is not None:
+        mask = filter_mask(_bm25_metadata, category, language)
+    sparse_scores, sparse_ids = bm25.search_batch(queries, k, mask=mask)
+    if mode == "sparse":
+        fused_scores, fused_ids = sparse_scores, sparse_ids
+    else:
+        rule_index = get_rule_index()
+        dense_scores, dense_ids = rule_index.search_ids(
+            get_query_embeddings(queries), k, category=category, language=language
+        )
+        dense_ids = rule_index.positions(dense_ids)
+        if threshold is not None:
+            dense_ids = np.where(dense_scores >= threshold, dense_ids, -1)
+
+        fused = reciprocal_rank_fusion([dense_ids, sparse_ids], n_docs=len(bm25.docs))
+        fused_ids = np.argsort(-fused, axis=1, kind="stable")[:, :k]
+        fused_scores = np.take_along_axis(fused, fused_ids, axis=1)
+        fused_ids[fused_scores <= 0] = -1
+
+    batch_results = []
+    for row_scores, row_ids in zip(fused_scores, fused_ids):
+        keep = row_ids != -1
+        results = [
+            {"doc": bm25.docs[idx], "score": score}
+            for idx, score in zip(row_ids[keep].tolist(), row_scores[keep].tolist())
+        ]
+        batch_results.append(([r["doc"] for r in results], results))
+    return batch_results
+
+
+def search_docs_hybrid(
+    query: str,
+    k: int = 15,
+    threshold: float | None = None,
+    mode: str = "hybrid",
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> Tuple[List[str], List[dict]]:
+    return search_docs_hybrid_batch(
+        [query], k=k, threshold=threshold, mode=mode, category=category, language=language
+    )[0]
+
+
+def reload_rules(docs: List[str | dict] = None) -> Tuple[List[int], List[int]]:
+    # 長時間執行的服務用：重新讀取 rag_data.py，只 embed 有變動的 rule，不重新載入模型
+    if docs is None:
+        import importlib
+        import datas.RAG_data.rag_data as rag_data
+        docs = importlib.reload(rag_data).rule_records
+
+    if _rule_index is None:
+        build_rule_index(docs)
+        return list(_rule_index.ids.tolist()), []
+
+    added, removed = _rule_index.sync_rules(docs)
+    print(f"[RAG] Reloaded rules: {len(added)} added, {len(removed)} removed, total docs = {_rule_index.ntotal}")
+    return added, removed
+
+
+def search_docs_range_ids(
+    queries: List[str],
+    threshold: float,
+    max_results: int | None = None,
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # 用 get_rule_index().docs_for(ids) 取回 rule 內容
+    return get_rule_index().search_range_batch(
+        queries, threshold, max_results=max_results, category=category, language=language
+    )
+
+
+def search_docs_range(
+    query: str,
+    threshold: float,
+    max_results: int | None = None,
+    category: str | List[str] | None = None,
+    language: str | List[str] | None = None
+) -> Tuple[List[str], List[dict]]:
+    return get_rule_index().search_range(
+        query, threshold, max_results=max_results, category=category, language=language
+    )
+
+
+def get_rule_embeddings(rules: List[str]) -> np.ndarray:
+    # 已在 rule index 裡的 rule 直接取用建 index 時的向量，不在的才 embed
+    rule_index = get_rule_index()
+    positions = rule_index.positions(np.array([rule_id(text_hash(r)) for r in rules], dtype="int64"))
+    if rule_index.embeddings is None:
+        return get_query_embeddings(rules)
+
+    vectors = np.empty((len(rules), np.asarray(rule_index.embeddings).shape[1]), dtype="float32")
+    known = positions != -1
+    vectors[known] = np.asarray(rule_index.embeddings)[positions[known]]
+    if not known.all():
+        vectors[~known] = get_query_embeddings([r for r, k in zip(rules, known) if not k])
+    return vectors
@@ -0,0 +1,303 @@
+import os
+import re
+from collections import Counter, deque
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+# Qwen3 的 <think> / </think> token id
+THINK_START_TOKEN_ID = 151667
+THINK_END_TOKEN_ID = 151668
+
+# 不設定時的 stage config：只有 max_new_tokens，沒有 thinking 上限與停止條件。
+# max_thinking_tokens：thinking 超過這個 token 數時強制輸出 </think>，讓模型轉去寫回答
+DEFAULT_GENERATION_CONFIG = {
+    "max_new_tokens": 32768,
+    "max_thinking_tokens": None,
+    "stop_strings": [],
+    "stop_patterns": [],
+    "stop_when": None,
+    "stop_on_repetition": True,
+}
+
+# 重複偵測：最近 REPETITION_WINDOW 個 n-gram 中，重複出現的比例達到 REPETITION_THRESHOLD 就視為在原地打轉
+REPETITION_NGRAM_SIZE = int(os.getenv("REPETITION_NGRAM_SIZE", 12))
+REPETITION_WINDOW = int(os.getenv("REPETITION_WINDOW", 1024))
+REPETITION_THRESHOLD = float(os.getenv("REPETITION_THRESHOLD", 0.6))
+
+# 偵測到重複後重試一次時改用的取樣設定
+RETRY_SAMPLING = {"do_sample": True, "temperature": 0.9, "top_p": 0.95, "repetition_penalty": 1.1}
+
+# stop_patterns / stop_when 只在新 token 含有這些字元時才檢查，避免每個 token 都掃一次整段回答
+STOP_CHECK_CHARS = "]`}"
+
+
+def generation_config(**overrides) -> dict:
+    unknown = set(overrides) - set(DEFAULT_GENERATION_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown generation config keys: {sorted(unknown)}")
+    return {**DEFAULT_GENERATION_CONFIG, **overrides}
+
+
+def closed_json_list(answer: str) -> bool:
+    # 回答中第一個從行首開始的 JSON list 已經閉合（在 ``` 區塊內時，要等區塊也結束）
+    match = re.search(r"^\s*\[", answer, re.MULTILINE)
+    if match is None:
+        return False
+
+    depth, in_string, escaped = 0, False, False
+    for index in range(match.end() - 1, len(answer)):
+        char = answer[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if depth == 0:
+                in_fence = answer.count("```", 0, match.start()) % 2 == 1
+                return not in_fence or "```" in answer[index:]
+    return False
+
+
+class RepetitionDetector:
+    # 逐 token 維護視窗內 n-gram 的計數，每個 token O(1)
+
+    def __init__(self, ngram_size: int = REPETITION_NGRAM_SIZE, window: int = REPETITION_WINDOW,
+                 threshold: float = REPETITION_THRESHOLD, max_new_tokens: int = None):
+        # 視窗要填滿才會判斷；生成上限較短時把視窗縮到整段生成 n-gram 數的一半，生成到一半就能偵測、提早中止
+        if max_new_tokens is not None:
+            window = max(1, min(window, (max_new_tokens - ngram_size + 1) // 2))
+        self.ngram_size = ngram_size
+        self.window = window
+        self.threshold = threshold
+        self.tokens = deque(maxlen=ngram_size)
+        self.ngrams = deque()
+        self.counts = Counter()
+        self.generated_tokens = 0
+        self.degenerate = False
+
+    def update(self, token_ids: list[int]) -> bool:
+        for token_id in token_ids:
+            self.generated_tokens += 1
+            self.tokens.append(token_id)
+            if len(self.tokens) < self.ngram_size:
+                continue
+            ngram = tuple(self.tokens)
+            self.ngrams.append(ngram)
+            self.counts[ngram] += 1
+            if len(self.ngrams) > self.window:
+                oldest = self.ngrams.popleft()
+                self.counts[oldest] -= 1
+                if not self.counts[oldest]:
+                    del self.counts[oldest]
+            if len(self.ngrams) == self.window and 1 - len(self.counts) / self.window >= self.threshold:
+                self.degenerate = True
+        return self.degenerate
+
+
+class RepetitionStoppingCriteria(StoppingCriteria):
+    # 只做重複偵測的 StoppingCriteria，給 magicoder / llama3 pipeline 這類不經過 StageStopper 的生成使用。
+    # 第一次呼叫時 input_ids 是 prompt 加上第一個新 token，由此得知 prompt 長度
+
+    def __init__(self, max_new_tokens: int = None):
+        self.max_new_tokens = max_new_tokens
+        self.detectors: list[RepetitionDetector] = []
+        self.prompt_length = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+            self.detectors = [RepetitionDetector(max_new_tokens=self.max_new_tokens) for _ in range(input_ids.shape[0])]
+        done = []
+        for row, detector in zip(input_ids, self.detectors):
+            new_ids = row[self.prompt_length + detector.generated_tokens:].tolist()
+            done.append(detector.degenerate or detector.update(new_ids))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def usage(self, max_new_tokens: int) -> dict:
+        # 與 StageStopper.usage 相同格式（沒有 thinking 區分），只看第一個 row
+        detector = self.detectors[0] if self.detectors else RepetitionDetector()
+        if detector.degenerate:
+            stop_reason = "repetition"
+        elif detector.generated_tokens >= max_new_tokens:
+            stop_reason = "max_new_tokens"
+        else:
+            stop_reason = "eos"
+        return {
+            "thinking_tokens": 0,
+            "answer_tokens": detector.generated_tokens,
+            "forced_think_end": False,
+            "degenerate": detector.degenerate,
+            "stop_reason": stop_reason,
+        }
+
+
+class StageStopper:
+    # 逐 token 追蹤單一序列：thinking / 回答各用了多少 token，以及是否該依 stage config 停止
+
+    def __init__(self, tokenizer, config: dict, thinking: bool = False):
+        self.tokenizer = tokenizer
+        self.config = config
+        self.thinking = thinking
+        self.prompt_thinking = thinking
+        self.started = False
+        self.thinking_tokens = 0
+        self.answer_tokens = 0
+        self.answer_text = ""
+        self.stop_reason = None
+        self.forced_think_end = False
+        self.repetition = RepetitionDetector(max_new_tokens=config["max_new_tokens"]) \
+            if config["stop_on_repetition"] else None
+        self._checks_answer = bool(config["stop_strings"] or config["stop_patterns"] or config["stop_when"])
+
+    def update(self, token_ids: list[int]) -> str | None:
+        # 回傳停止原因（尚未停止時為 None）
+        answer_ids = []
+        for token_id in token_ids:
+            if not self.started:
+                self.started = True
+                if token_id == THINK_START_TOKEN_ID:
+                    self.thinking = True
+            if self.thinking:
+                if token_id == THINK_END_TOKEN_ID:
+                    self.thinking = False
+                    # 用完預算後出現的 </think> 一定是被強制的
+                    max_thinking_tokens = self.config["max_thinking_tokens"]
+                    self.forced_think_end = max_thinking_tokens is not None \
+                        and self.thinking_tokens >= max_thinking_tokens
+                self.thinking_tokens += 1
+            else:
+                self.answer_tokens += 1
+                answer_ids.append(token_id)
+
+        # thinking 與回答都可能陷入重複
+        if self.repetition is not None and self.repetition.update(token_ids):
+            self.stop_reason = "repetition"
+        elif answer_ids and self._checks_answer:
+            self.stop_reason = self._check_answer(self.tokenizer.decode(answer_ids, skip_special_tokens=True))
+        return self.stop_reason
+
+    def over_thinking_budget(self) -> bool:
+        # 下一個 token 必須是 </think>
+        max_thinking_tokens = self.config["max_thinking_tokens"]
+        return self.thinking and max_thinking_tokens is not None and self.thinking_tokens >= max_thinking_tokens
+
+    def over_thinking_budget_at(self, generated_ids: torch.Tensor) -> bool:
+        # 與 over_thinking_budget 相同，但只看到目前為止產生的 token 判斷，不依賴 update 過的狀態。
+        # assisted generation 會在還沒確定接受的 draft token 上呼叫 logits processor，這時的狀態還沒跟上
+        max_thinking_tokens = self.config["max_thinking_tokens"]
+        if max_thinking_tokens is None or len(generated_ids) < max_thinking_tokens:
+            return False
+        thinking = self.prompt_thinking or int(generated_ids[0]) == THINK_START_TOKEN_ID
+        return thinking and not bool((generated_ids == THINK_END_TOKEN_ID).any())
+
+    def _check_answer(self, new_text: str) -> str | None:
+        self.answer_text += new_text
+        # 只看尾端：stop string 一定落在這次新增的文字附近
+        for stop_string in self.config["stop_strings"]:
+            if stop_string in self.answer_text[-(len(new_text) + len(stop_string)):]:
+                return "stop_string"
+        if not any(char in new_text for char in STOP_CHECK_CHARS):
+            return None
+        if any(re.search(pattern, self.answer_text) for pattern in self.config["stop_patterns"]):
+            return "stop_pattern"
+        if self.config["stop_when"] is not None and self.config["stop_when"](self.answer_text):
+            return "stop_when"
+        return None
+
+    def usage(self, eos_reached: bool = False) -> dict:
+        if self.stop_reason is not None:
+            stop_reason = self.stop_reason
+        elif eos_reached:
+            stop_reason = "eos"
+        else:
+            stop_reason = "max_new_tokens"
+        return {
+            "thinking_tokens": self.thinking_tokens,
+            "answer_tokens": self.answer_tokens,
+            "forced_think_end": self.forced_think_end,
+            "degenerate": stop_reason == "repetition",
+            "stop_reason": stop_reason,
+        }
+
+
+def force_think_end(scores: torch.Tensor) -> torch.Tensor:
+    # 單一 row 的 logits：只留下 </think>
+    forced = torch.full_like(scores, float("-inf"))
+    forced[..., THINK_END_TOKEN_ID] = 0
+    return forced
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    # thinking 用完 max_thinking_tokens 的 row，下一個 token 強制為 </think>。
+    # 直接由 input_ids 判斷，draft model 提出的 token 與主模型逐位置驗證時都會套用正確的預算
+
+    def __init__(self, stoppers: list[StageStopper], prompt_length: int):
+        self.stoppers = stoppers
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row, stopper in enumerate(self.stoppers):
+            if stopper.over_thinking_budget_at(input_ids[row, self.prompt_length:]):
+                scores[row] = force_think_end(scores[row])
+        return scores
+
+
+class StageStoppingCriteria(StoppingCriteria):
+    # 給 model.generate 用的 StoppingCriteria，每個 batch row 一個 StageStopper
+
+    def __init__(self, stoppers: list[StageStopper], prompt_length: int):
+        self.stoppers = stoppers
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = []
+        for row, stopper in zip(input_ids, self.stoppers):
+            seen = stopper.thinking_tokens + stopper.answer_tokens
+            # assisted generation 一次會接受好幾個 token；逐 token 更新，停在條件成立的那個 token，
+            # stopper 的 token 數就是該保留的輸出長度
+            for token_id in row[self.prompt_length + seen:].tolist():
+                if stopper.stop_reason is not None or stopper.update([token_id]) is not None:
+                    break
+            done.append(stopper.stop_reason is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def prompt_opens_thinking(text: str) -> bool:
+    # Thinking-2507 的 chat template 會直接在 prompt 結尾放 <think>
+    return text.rstrip().endswith("<think>")
+
+
+# 每次生成的 run metadata，{stage: [{"prompt_tokens", "thinking_tokens", "answer_tokens", "forced_think_end",
+# "degenerate", "stop_reason"}, ...]}
+token_usage: dict[str, list[dict]] = {}
+
+
+def log_token_usage(stage: str, prompt_tokens: int, usage: dict) -> None:
+    record = {"prompt_tokens": prompt_tokens, **usage}
+    token_usage.setdefault(stage, []).append(record)
+    forced = " (thinking budget reached)" if usage["forced_think_end"] else ""
+    degenerate = " [degenerate]" if usage["degenerate"] else ""
+    print(f"[TokenUsage] {stage}: prompt {prompt_tokens}, thinking {usage['thinking_tokens']}{forced}, "
+          f"answer {usage['answer_tokens']}, stopped by {usage['stop_reason']}{degenerate}")
+
+
+def report_token_usage() -> None:
+    for stage, records in token_usage.items():
+        generated = [r["thinking_tokens"] + r["answer_tokens"] for r in records]
+        reasons = {}
+        for record in records:
+            reasons[record["stop_reason"]] = reasons.get(record["stop_reason"], 0) + 1
+        forced = sum(record["forced_think_end"] for record in records)
+        degenerate = sum(record["degenerate"] for record in records)
+        print(f"[TokenUsage] {stage}: {len(records)} requests, mean {sum(generated) / len(generated):.0f} / "
+              f"max {max(generated)} generated tokens, stop reasons {reasons}, thinking budget reached {forced}, "
+              f"degenerate {degenerate}")
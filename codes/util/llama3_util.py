@@ -2,13 +2,16 @@ import datetime
 
 import torch
 import transformers
-from transformers import AutoTokenizer, pipeline
+from transformers import AutoTokenizer, StoppingCriteriaList, pipeline
 import os
 
+from codes.util.generation_budget import RETRY_SAMPLING, RepetitionStoppingCriteria, log_token_usage
 from codes.util.memory import get_max_memory
 
 os.environ["PYTORCH_ALLOC_CONF"] = "expandable_segments:True"
 
+MAX_NEW_TOKENS = 2048
+
 
 def load_llama3_model():
     model_id = "meta-llama/Llama-3.1-8B-Instruct"
@@ -33,15 +36,24 @@ def load_llama3_model():
     return llm_pipeline, tokenizer
 
 
-def llama3_ask(system_prompt: str, question_prompt: str, llm_pipeline):
+def llama3_ask(system_prompt: str, question_prompt: str, llm_pipeline, retry_degenerate: bool = False):
+    # retry_degenerate: 因重複而中止時，改用 RETRY_SAMPLING 再生成一次
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": question_prompt},
     ]
 
-    outputs = llm_pipeline(
-        messages,
-        max_new_tokens=2048,
-    )
+    for attempt in range(2 if retry_degenerate else 1):
+        repetition = RepetitionStoppingCriteria(max_new_tokens=MAX_NEW_TOKENS)
+        outputs = llm_pipeline(
+            messages,
+            max_new_tokens=MAX_NEW_TOKENS,
+            stopping_criteria=StoppingCriteriaList([repetition]),
+            **(RETRY_SAMPLING if attempt else {})
+        )
+        usage = repetition.usage(max_new_tokens=MAX_NEW_TOKENS)
+        log_token_usage("llama3", repetition.prompt_length or 0, usage)
+        if not usage["degenerate"]:
+            break
     print(datetime.datetime.now(), "Generation completed.")
     return outputs
@@ -3,10 +3,13 @@ import os
 import re
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList
 
+from codes.util.generation_budget import RETRY_SAMPLING, RepetitionStoppingCriteria, log_token_usage
 from codes.util.memory import get_max_memory
 
+MAX_NEW_TOKENS = 512
+
 
 def load_magicoder_model():
     os.environ["PYTORCH_ALLOC_CONF"] = "expandable_segments:True"
@@ -37,17 +40,24 @@ def load_magicoder_model():
     return model, tokenizer, device
 
 
-def magicoder_ask(prompt: str, model, tokenizer, device):
+def magicoder_ask(prompt: str, model, tokenizer, device, retry_degenerate: bool = False):
+    # retry_degenerate: 因重複而中止時，改用 RETRY_SAMPLING 再生成一次
     inputs = tokenizer(prompt, return_tensors="pt").to(device)
 
-    with torch.inference_mode():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=512,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.9
-        )
+    sampling = {"do_sample": True, "temperature": 0.7, "top_p": 0.9}
+    for attempt in range(2 if retry_degenerate else 1):
+        repetition = RepetitionStoppingCriteria(max_new_tokens=MAX_NEW_TOKENS)
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=MAX_NEW_TOKENS,
+                stopping_criteria=StoppingCriteriaList([repetition]),
+                **(RETRY_SAMPLING if attempt else sampling)
+            )
+        usage = repetition.usage(max_new_tokens=MAX_NEW_TOKENS)
+        log_token_usage("magicoder", inputs.input_ids.shape[1], usage)
+        if not usage["degenerate"]:
+            break
 
     result_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
     match = re.search(r"@@ Response\s*(.*)", result_text, re.DOTALL)
@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+PREFIX_CACHE_SIZE = 8
+
+
+def copy_cache(cache: DynamicCache) -> DynamicCache:
+    # generate 會在 cache 後面接上新 token，每次使用都給一份新的，快取本身不會被改到
+    return DynamicCache([(layer.keys, layer.values) for layer in cache.layers])
+
+
+class PrefixCache:
+    # 以 token ids 為 key 保存共用 prompt 開頭的 past key values。
+    # markers 依序定義巢狀的 prefix（例如 global rules -> 該檔案的 RAG rules），
+    # 較長的一層從較短的一層接續 prefill，不會從頭再算一次
+
+    def __init__(self, model, tokenizer, markers: list[str], max_entries: int = PREFIX_CACHE_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.markers = markers
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, DynamicCache] = OrderedDict()
+        self.stats: dict[str, dict] = {}
+
+    def prefix_ids(self, text: str) -> tuple[list[int], list[list[int]]]:
+        # 回傳 (text 的 token ids, 每一層 prefix 的 token ids)
+        encoding = self.tokenizer(text, return_offsets_mapping=True)
+        input_ids = encoding["input_ids"]
+        prefixes = []
+        for marker in self.markers:
+            position = text.find(marker)
+            if position == -1:
+                break
+            end = position + len(marker)
+            ids = [i for i, (_, token_end) in zip(input_ids, encoding["offset_mapping"]) if token_end <= end]
+            # 最後一個 token 可能與後面的文字合併成不同的 token，去掉它讓不同 prompt 的 prefix 一致
+            prefixes.append(ids[:-1])
+        return input_ids, prefixes
+
+    def _longest_prefix(self, input_ids: list[int]) -> tuple[int, DynamicCache | None]:
+        best = None
+        for key in self.entries:
+            if len(key) < len(input_ids) and (best is None or len(key) > len(best)) \
+                    and tuple(input_ids[:len(key)]) == key:
+                best = key
+        if best is None:
+            return 0, None
+        self.entries.move_to_end(best)
+        return len(best), self.entries[best]
+
+    @torch.no_grad()
+    def _add(self, prefix_ids: list[int]) -> None:
+        key = tuple(prefix_ids)
+        if not key or key in self.entries:
+            if key:
+                self.entries.move_to_end(key)
+            return
+
+        length, base = self._longest_prefix(prefix_ids)
+        cache = copy_cache(base) if base is not None else DynamicCache()
+        input_ids = torch.tensor([prefix_ids[length:]], device=self.model.device)
+        self.model(input_ids=input_ids, past_key_values=cache, use_cache=True, logits_to_keep=1)
+        self.entries[key] = cache
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, text: str, label: str = "default") -> tuple[list[int], int, DynamicCache | None]:
+        # 回傳 (token ids, 已快取的 prefix 長度, 可直接交給 generate 的 cache 複本)
+        input_ids, prefixes = self.prefix_ids(text)
+        for prefix in prefixes:
+            self._add(prefix)
+        length, cache = self._longest_prefix(input_ids)
+
+        stats = self.stats.setdefault(label, {"requests": 0, "prompt_tokens": 0, "reused_tokens": 0})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += len(input_ids)
+        stats["reused_tokens"] += length
+        return input_ids, length, copy_cache(cache) if cache is not None else None
+
+    def report(self) -> None:
+        for label, stats in self.stats.items():
+            ratio = stats["reused_tokens"] / max(1, stats["prompt_tokens"])
+            print(f"[PrefixCache] {label}: {stats['reused_tokens']}/{stats['prompt_tokens']} prompt tokens "
+                  f"reused ({ratio:.1%}) over {stats['requests']} requests")
+
+
+@torch.no_grad()
+def prefill_seconds(model, input_ids: list[int], prefix_length: int = 0, cache: DynamicCache | None = None) -> float:
+    # 只量 prefill（不含 decode），用來比較有無 prefix cache 的差異
+    start = time.perf_counter()
+    suffix = torch.tensor([input_ids[prefix_length:]], device=model.device)
+    model(input_ids=suffix, past_key_values=cache if cache is not None else DynamicCache(), use_cache=True,
+          logits_to_keep=1)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
@@ -1,11 +1,59 @@
 import datetime
+import os
+import time
+from pathlib import Path
+from threading import Thread
+from typing import Iterator
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessorList, StoppingCriteriaList,
+    TextIteratorStreamer, TextStreamer
+)
 from peft import PeftModel
 
+from codes.util.generation_budget import (
+    RETRY_SAMPLING, THINK_END_TOKEN_ID, StageStopper, StageStoppingCriteria, ThinkingBudgetProcessor,
+    generation_config, log_token_usage, prompt_opens_thinking, token_usage
+)
 
-def load_qwen3_model(lora_path: str = None, model_name: str = "Qwen/Qwen3-30B-A3B-Thinking-2507"):
+
+# 與主模型共用 tokenizer 的小模型，作為 assisted generation 的 draft model
+DRAFT_MODEL_NAME = "Qwen/Qwen3-1.7B"
+
+# 主模型 -> draft model；以 id 對應，避免把 draft model 註冊成主模型的 submodule
+_draft_models: dict[int, object] = {}
+
+
+def use_draft_model(model, draft_model) -> None:
+    # 之後對這個 model 的 qwen3_ask 都以 draft_model 做 assisted generation；draft_model 為 None 時取消
+    if draft_model is None:
+        _draft_models.pop(id(model), None)
+    else:
+        _draft_models[id(model)] = draft_model
+
+
+def draft_model_for(model):
+    return _draft_models.get(id(model))
+
+
+def load_draft_model(model_name: str = DRAFT_MODEL_NAME, lora_path: str = None):
+    # draft model 只負責提出候選 token，用 bf16 載入，不量化以求最快
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        device_map="auto",
+        dtype=torch.bfloat16,
+    )
+    if lora_path:
+        # 合併 LoRA 權重，draft 的每一步不必多算 adapter
+        draft_model = PeftModel.from_pretrained(draft_model, lora_path).merge_and_unload()
+    draft_model.eval()
+    print(datetime.datetime.now(), "Draft model loaded")
+    return draft_model
+
+
+def load_qwen3_model(lora_path: str = None, model_name: str = "Qwen/Qwen3-30B-A3B-Thinking-2507",
+                     draft_model_name: str = None, draft_lora_path: str = None):
 
     print("Loading model across all GPUs...")
     if model_name in ["Qwen/Qwen3-30B-A3B-Thinking-2507"]:
@@ -40,32 +88,340 @@ def load_qwen3_model(lora_path: str = None, model_name: str = "Qwen/Qwen3-30B-A3
         model = PeftModel.from_pretrained(model, lora_path)
         print(datetime.datetime.now(), "LoRa loaded")
 
+    if os.getenv("RAG_EMBEDDING_BACKEND") == "generation":
+        # RAG 直接用這個模型的 hidden states 做 embedding，不再另外載入 Qwen3-Embedding-4B
+        from codes.util.faiss_util import use_generation_model_embeddings
+        use_generation_model_embeddings(model, tokenizer)
+
+    if draft_model_name:
+        # draft 必須與主模型共用 tokenizer（例如 Qwen3-1.7B 之於 Qwen3-30B-A3B）
+        use_draft_model(model, load_draft_model(draft_model_name, lora_path=draft_lora_path))
+
     return model, tokenizer
 
-def qwen3_ask(prompt: str, model, tokenizer, max_new_tokens: int = 16784):
+THINK_START_TAG = "<think>"
+THINK_END_TAG = "</think>"
+
+
+def split_thinking(output_ids: list[int], tokenizer) -> tuple[str, str]:
+    # 以最後一個 </think> 切開思考內容與回答
+    try:
+        index = len(output_ids) - output_ids[::-1].index(THINK_END_TOKEN_ID)
+    except ValueError:
+        index = 0
+
+    thinking_content = tokenizer.decode(output_ids[:index], skip_special_tokens=True).strip("\n")
+    content = tokenizer.decode(output_ids[index:], skip_special_tokens=True).strip("\n")
+    return content, thinking_content
+
+
+def eos_token_ids(model, tokenizer) -> set[int]:
+    eos = model.generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, list) else [eos]) if eos is not None else set()
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    return ids
+
+
+def build_chat_text(prompt: str, tokenizer) -> str:
     messages = [
         {"role": "user", "content": prompt}
     ]
-    text = tokenizer.apply_chat_template(
+    return tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,
     )
+
+
+def _prepare_generation(text: str, model, tokenizer, max_new_tokens: int, prefix_cache, stage: str,
+                        stage_config: dict, max_thinking_tokens: int = None) -> tuple:
+    # 回傳 (model_inputs, generate 參數, StageStopper)；stage_config 會覆蓋 max_new_tokens，
+    # max_thinking_tokens 會覆蓋 stage_config 裡的 thinking 預算
+    config = stage_config if stage_config is not None else generation_config(max_new_tokens=max_new_tokens)
+    if max_thinking_tokens is not None:
+        config = {**config, "max_thinking_tokens": max_thinking_tokens}
     model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+    stopper = StageStopper(tokenizer, config, thinking=prompt_opens_thinking(text))
+    generate_kwargs = {
+        "max_new_tokens": config["max_new_tokens"],
+        "stopping_criteria": StoppingCriteriaList([
+            StageStoppingCriteria([stopper], prompt_length=model_inputs.input_ids.shape[1])
+        ]),
+        # thinking 超過預算時強制輸出 </think>
+        "logits_processor": LogitsProcessorList([
+            ThinkingBudgetProcessor([stopper], prompt_length=model_inputs.input_ids.shape[1])
+        ]),
+    }
+    draft_model = draft_model_for(model)
+    if draft_model is not None:
+        # assisted generation：draft model 一次提出數個 token，主模型一次 forward 驗證。
+        # ThinkingBudgetProcessor 由 input_ids 判斷、StoppingCriteria 只看已接受的 token，兩者都不受 draft 影響
+        generate_kwargs["assistant_model"] = draft_model
+    elif prefix_cache is not None:
+        # 共用的 prompt 開頭直接沿用快取的 KV，只 prefill 後面不同的部分。
+        # 有 draft model 時不用：draft 沒有對應的 cache，兩者一起交給 generate 結果會和一般生成不同
+        _, prefix_length, past_key_values = prefix_cache.lookup(text, label=stage)
+        if past_key_values is not None:
+            generate_kwargs["past_key_values"] = past_key_values
+    return model_inputs, generate_kwargs, stopper
 
-    generated_ids = model.generate(
-        **model_inputs,
-        max_new_tokens=max_new_tokens
-    )
-    output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
 
-    try:
-        index = len(output_ids) - output_ids[::-1].index(151668)
-    except ValueError:
-        index = 0
+def qwen3_ask(prompt: str, model, tokenizer, max_new_tokens: int = 16784, prefix_cache=None, stage: str = "default",
+              stage_config: dict = None, max_thinking_tokens: int = None, retry_degenerate: bool = False):
+    # retry_degenerate: 因重複而中止時，改用 RETRY_SAMPLING 再生成一次
+    text = build_chat_text(prompt, tokenizer)
+    for attempt in range(2 if retry_degenerate else 1):
+        model_inputs, generate_kwargs, stopper = _prepare_generation(
+            text, model, tokenizer, max_new_tokens, prefix_cache, stage, stage_config, max_thinking_tokens)
 
-    thinking_content = tokenizer.decode(output_ids[:index], skip_special_tokens=True).strip("\n")
-    content = tokenizer.decode(output_ids[index:], skip_special_tokens=True).strip("\n")
+        generated_ids = model.generate(
+            **model_inputs,
+            **generate_kwargs,
+            **(RETRY_SAMPLING if attempt else {})
+        )
+        output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
+        if stopper.stop_reason is not None:
+            # assisted generation 停止時可能多接受了幾個 token，裁到停止條件成立的位置，與一般生成一致
+            output_ids = output_ids[:stopper.thinking_tokens + stopper.answer_tokens]
+        eos_reached = bool(output_ids) and output_ids[-1] in eos_token_ids(model, tokenizer)
+        log_token_usage(stage, model_inputs.input_ids.shape[1], stopper.usage(eos_reached=eos_reached))
+        if stopper.stop_reason != "repetition":
+            break
+        print(datetime.datetime.now(), f"[{stage}] Degenerate repetition detected, generation aborted.")
+
+    content, thinking_content = split_thinking(output_ids, tokenizer)
     print(datetime.datetime.now(), "Generation completed.")
     return content, thinking_content
 
+
+class ThinkingSplitter:
+    # 把 streamer 吐出的文字切成 ("thinking", chunk) / ("answer", chunk)。
+    # </think> 可能被切在兩個 chunk 之間，thinking 狀態下保留最後幾個字元等下一個 chunk
+
+    def __init__(self, prompt_text: str):
+        # Thinking-2507 的 chat template 已經在 prompt 結尾放了 <think>；其他模型要看輸出開頭
+        self.channel = "thinking" if prompt_opens_thinking(prompt_text) else "start"
+        self.buffer = ""
+        self.closed = False
+
+    def feed(self, text: str) -> list[tuple[str, str]]:
+        self.buffer += text
+        chunks = []
+        if self.channel == "start":
+            stripped = self.buffer.lstrip()
+            if THINK_START_TAG.startswith(stripped):
+                return chunks
+            if stripped.startswith(THINK_START_TAG):
+                self.channel, self.buffer = "thinking", stripped[len(THINK_START_TAG):]
+            else:
+                self.channel = "answer"
+
+        if self.channel == "thinking":
+            index = self.buffer.find(THINK_END_TAG)
+            if index == -1:
+                keep = len(THINK_END_TAG) - 1
+                if len(self.buffer) > keep:
+                    chunks.append(("thinking", self.buffer[:-keep]))
+                    self.buffer = self.buffer[-keep:]
+                return chunks
+            chunks.append(("thinking", self.buffer[:index]))
+            self.channel, self.buffer, self.closed = "answer", self.buffer[index + len(THINK_END_TAG):], True
+
+        if self.buffer:
+            chunks.append(("answer", self.buffer))
+            self.buffer = ""
+        return chunks
+
+    def finish(self) -> list[tuple[str, str]]:
+        channel = "thinking" if self.channel == "thinking" else "answer"
+        chunks = [(channel, self.buffer)] if self.buffer else []
+        self.buffer = ""
+        return chunks
+
+
+# 每個 stage 的 streaming 時間，{stage: [{"first_output": 秒, "first_answer": 秒, "total": 秒}, ...]}
+stream_timings: dict[str, list[dict]] = {}
+
+
+class StageFileStreamer(TextStreamer):
+    # 給不經過 model.generate 的生成（continuous batching engine）用：每產生一個 token 就 put 一次，
+    # 解碼出的文字切成 thinking / 回答，分別寫進檔案並 flush。
+    # 同時記錄從 start（request 送出的時間）到第一個可見輸出 / 第一個回答字元的時間，格式與 stream_timings 相同
+    def __init__(self, tokenizer, prompt_text: str, answer_path: Path = None, thinking_path: Path = None,
+                 stage: str = "default", start: float = None, timing: dict = None):
+        super().__init__(tokenizer, skip_special_tokens=True)
+        self.splitter = ThinkingSplitter(prompt_text)
+        self.files = {
+            channel: open(str(path), "w", encoding="utf-8") if path is not None else None
+            for channel, path in (("answer", answer_path), ("thinking", thinking_path))
+        }
+        self.answer_started = False
+        self.stage = stage
+        self.start = time.perf_counter() if start is None else start
+        # 重試時沿用上一次的 timing，第一個輸出的時間仍從最初送出時算起
+        self.timing = timing if timing is not None else {"first_output": None, "first_answer": None, "total": None}
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        chunks = self.splitter.feed(text)
+        if stream_end:
+            chunks += self.splitter.finish()
+        for channel, chunk in chunks:
+            if channel == "answer" and not self.answer_started:
+                chunk = chunk.lstrip("\n")
+                self.answer_started = bool(chunk)
+            if not chunk:
+                continue
+            elapsed = time.perf_counter() - self.start
+            if self.timing["first_output"] is None:
+                self.timing["first_output"] = elapsed
+            if channel == "answer" and self.timing["first_answer"] is None:
+                self.timing["first_answer"] = elapsed
+                print(datetime.datetime.now(), f"[{self.stage}] first answer token after {elapsed:.2f}s")
+            if self.files[channel] is not None:
+                self.files[channel].write(chunk)
+                self.files[channel].flush()
+        if stream_end:
+            self.close()
+
+    def close(self) -> None:
+        for f in self.files.values():
+            if f is not None:
+                f.close()
+
+    def record_timing(self) -> None:
+        self.timing["total"] = time.perf_counter() - self.start
+        stream_timings.setdefault(self.stage, []).append(self.timing)
+
+
+def qwen3_stream(prompt: str, model, tokenizer, max_new_tokens: int = 16784, prefix_cache=None,
+                 stage: str = "default", stage_config: dict = None, max_thinking_tokens: int = None,
+                 sampling: dict = None) -> Iterator[tuple[str, str]]:
+    # 邊生成邊 yield (channel, text)，channel 為 "thinking" 或 "answer"；sampling 覆蓋取樣設定（重試時的 RETRY_SAMPLING）
+    text = build_chat_text(prompt, tokenizer)
+    model_inputs, generate_kwargs, stopper = _prepare_generation(
+        text, model, tokenizer, max_new_tokens, prefix_cache, stage, stage_config, max_thinking_tokens)
+
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def generate():
+        try:
+            model.generate(**model_inputs, streamer=streamer, **generate_kwargs, **(sampling or {}))
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = Thread(target=generate, daemon=True)
+    thread.start()
+
+    splitter = ThinkingSplitter(text)
+    for new_text in streamer:
+        yield from splitter.feed(new_text)
+    yield from splitter.finish()
+    thread.join()
+    if errors:
+        raise errors[0]
+    generated = stopper.thinking_tokens + stopper.answer_tokens
+    log_token_usage(stage, model_inputs.input_ids.shape[1],
+                    stopper.usage(eos_reached=generated < generate_kwargs["max_new_tokens"]))
+
+
+def qwen3_ask_stream(prompt: str, model, tokenizer, max_new_tokens: int = 16784, prefix_cache=None,
+                     stage: str = "default", answer_path: Path = None, thinking_path: Path = None,
+                     stage_config: dict = None, max_thinking_tokens: int = None, retry_degenerate: bool = False):
+    # 與 qwen3_ask 回傳相同的 (content, thinking_content)，但每個 chunk 一產生就寫進檔案並 flush，
+    # 生成到一半中斷也保留已產生的內容；retry_degenerate: 因重複而中止時，改用 RETRY_SAMPLING 重新生成並重寫檔案
+    timing = {"first_output": None, "first_answer": None, "total": None}
+    start = time.perf_counter()
+    for attempt in range(2 if retry_degenerate else 1):
+        files = {
+            channel: open(str(path), "w", encoding="utf-8") if path is not None else None
+            for channel, path in (("answer", answer_path), ("thinking", thinking_path))
+        }
+        parts = {"answer": [], "thinking": []}
+        try:
+            for channel, chunk in qwen3_stream(prompt, model, tokenizer, max_new_tokens, prefix_cache, stage,
+                                               stage_config, max_thinking_tokens,
+                                               sampling=RETRY_SAMPLING if attempt else None):
+                if not chunk:
+                    continue
+                if channel == "answer" and not parts["answer"]:
+                    chunk = chunk.lstrip("\n")
+                    if not chunk:
+                        continue
+                elapsed = time.perf_counter() - start
+                if timing["first_output"] is None:
+                    timing["first_output"] = elapsed
+                if channel == "answer" and timing["first_answer"] is None:
+                    timing["first_answer"] = elapsed
+                    print(datetime.datetime.now(), f"[{stage}] first answer token after {elapsed:.2f}s")
+
+                parts[channel].append(chunk)
+                if files[channel] is not None:
+                    files[channel].write(chunk)
+                    files[channel].flush()
+        finally:
+            for f in files.values():
+                if f is not None:
+                    f.close()
+        # qwen3_stream 結束時已把這次的 token usage 記進 token_usage
+        if not token_usage[stage][-1]["degenerate"]:
+            break
+        print(datetime.datetime.now(), f"[{stage}] Degenerate repetition detected, generation aborted.")
+
+    timing["total"] = time.perf_counter() - start
+    stream_timings.setdefault(stage, []).append(timing)
+    print(datetime.datetime.now(), "Generation completed.")
+    return "".join(parts["answer"]).strip("\n"), "".join(parts["thinking"]).strip("\n")
+
+
+def report_stream_timings() -> None:
+    for stage, timings in stream_timings.items():
+        first_output = [t["first_output"] for t in timings if t["first_output"] is not None]
+        first_answer = [t["first_answer"] for t in timings if t["first_answer"] is not None]
+        total = [t["total"] for t in timings]
+        print(f"[Streaming] {stage}: first output {sum(first_output) / max(1, len(first_output)):.2f}s, "
+              f"first answer {sum(first_answer) / max(1, len(first_answer)):.2f}s, "
+              f"total {sum(total) / max(1, len(total)):.2f}s over {len(timings)} requests")
+
+
+def qwen3_ask_batch(prompts: list[str], model, tokenizer, max_new_tokens: int = 16784, batch_size: int = None):
+    # 一次 generate 處理一整個 batch；回傳與 prompts 同順序的 (content, thinking_content)
+    if not prompts:
+        return []
+    texts = [build_chat_text(prompt, tokenizer) for prompt in prompts]
+    # 長度相近的 prompt 排在同一個 batch，減少 padding
+    lengths = [len(ids) for ids in tokenizer(texts)["input_ids"]]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    batch_size = batch_size or len(texts)
+
+    eos_ids = eos_token_ids(model, tokenizer)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else min(eos_ids)
+
+    results = [None] * len(texts)
+    padding_side = tokenizer.padding_side
+    # 左側 padding：每個 row 的 prompt 都結束在同一個位置，新 token 直接接在後面
+    tokenizer.padding_side = "left"
+    try:
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            model_inputs = tokenizer([texts[i] for i in batch], return_tensors="pt", padding=True).to(model.device)
+
+            # 每個 row 產生 EOS 後就標記完成，全部完成時 generate 立即停止
+            generated_ids = model.generate(
+                **model_inputs,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=sorted(eos_ids),
+                pad_token_id=pad_id
+            )
+            new_ids = generated_ids[:, model_inputs.input_ids.shape[1]:].tolist()
+            for i, output_ids in zip(batch, new_ids):
+                # 只取到自己的 EOS 為止，後面是等待其他 row 時補上的 pad
+                end = next((j for j, t in enumerate(output_ids) if t in eos_ids), len(output_ids))
+                results[i] = split_thinking(output_ids[:end], tokenizer)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    print(datetime.datetime.now(), f"Batch generation of {len(texts)} prompts completed.")
+    return results
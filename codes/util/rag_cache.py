@@ -0,0 +1,236 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from codes.util.faiss_index_util import read_index, write_index
+
+# =========================
+# Cache location
+# =========================
+# 預設放在 repo 根目錄的 .rag_cache，可用 RAG_CACHE_DIR 覆寫
+RAG_CACHE_DIR = Path(os.getenv(
+    "RAG_CACHE_DIR",
+    str(Path(__file__).resolve().parents[2] / ".rag_cache")
+))
+USE_RAG_CACHE = os.getenv("RAG_CACHE", "1") == "1"
+RAG_MEMO_SIZE = int(os.getenv("RAG_MEMO_SIZE", "1024"))
+USE_RAG_MEMO_DISK = os.getenv("RAG_MEMO_DISK", "0") == "1"
+
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+INDEX_FILE_PREFIX = "index-"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def settings_hash(settings: dict) -> str:
+    # 模型名稱、pooling、max_length 等任何會改變向量的設定都要進 key
+    return text_hash(json.dumps(settings, sort_keys=True))[:16]
+
+
+class EmbeddingCache:
+
+    def __init__(self, settings: dict, cache_dir: Path = RAG_CACHE_DIR):
+        self.settings = settings
+        self.path = Path(cache_dir) / settings_hash(settings)
+
+    def _read_keys(self) -> List[str]:
+        manifest_path = self.path / MANIFEST_FILE
+        if not manifest_path.is_file():
+            return []
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)["keys"]
+
+    def _index_file(self, keys: List[str], index_settings: dict) -> Path:
+        # 檔名包含 index 設定與 rule keys，換 index 類型或 rule 改變都不會讀到舊檔
+        file_name = f"{INDEX_FILE_PREFIX}{settings_hash(index_settings)}-{settings_hash({'keys': keys})}.faiss"
+        return self.path / file_name
+
+    def has_index(self, keys: List[str], index_settings: dict) -> bool:
+        return self._index_file(keys, index_settings).is_file() and self._read_keys() == keys
+
+    def load_embeddings(self) -> np.ndarray | None:
+        emb_path = self.path / EMBEDDINGS_FILE
+        if not emb_path.is_file():
+            return None
+        return np.load(emb_path, mmap_mode="r")
+
+    def read_index(self, keys: List[str], index_settings: dict, dim: int):
+        return read_index(str(self._index_file(keys, index_settings)), index_settings["index_type"], dim)
+
+    def lookup(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        # 回傳已經算過的 rule embedding，只有新增或修改過的 rule 需要重新 embed
+        cached_keys = self._read_keys()
+        embeddings = self.load_embeddings()
+        if embeddings is None or len(cached_keys) != embeddings.shape[0]:
+            return {}
+        wanted = set(keys)
+        return {
+            key: np.array(embeddings[row])
+            for row, key in enumerate(cached_keys)
+            if key in wanted
+        }
+
+    def save(self, keys: List[str], embeddings: np.ndarray, index, index_settings: dict) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        # 先寫暫存檔再 rename，其他 process 正在 mmap 的舊檔不會被截斷
+        tmp_emb = self.path / (EMBEDDINGS_FILE + ".tmp")
+        with open(tmp_emb, "wb") as f:
+            np.save(f, np.ascontiguousarray(embeddings, dtype="float32"))
+        os.replace(tmp_emb, self.path / EMBEDDINGS_FILE)
+
+        index_file = self._index_file(keys, index_settings)
+        for stale in self.path.glob(f"{INDEX_FILE_PREFIX}{settings_hash(index_settings)}-*.faiss"):
+            if stale != index_file:
+                stale.unlink()
+        tmp_index = index_file.with_suffix(".tmp")
+        write_index(index, str(tmp_index))
+        os.replace(tmp_index, index_file)
+
+        # manifest 最後寫，確保 manifest 對得上時 embeddings / index 一定是完整的
+        # keys 是每條 rule 內容的 sha256，順序即 embeddings 的 row 順序；rule id 由 key 推得
+        tmp_manifest = self.path / (MANIFEST_FILE + ".tmp")
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "index": index_settings, "keys": keys}, f, indent=1)
+        os.replace(tmp_manifest, self.path / MANIFEST_FILE)
+
+    def append(self, keys: List[str], embeddings: np.ndarray) -> None:
+        # 增量新增 rule：只在 embeddings.npy 尾端追加新的 row、manifest 追加 keys，不重寫既有向量。
+        # index 檔不更新；下次 build 時 has_index 對不上，直接用快取的向量重建 index，不需要重新 embed
+        cached_keys = self._read_keys()
+        known = set(cached_keys)
+        rows = [i for i, key in enumerate(keys) if key not in known]
+        if not rows:
+            return
+        new_keys = [keys[i] for i in rows]
+        new_embeddings = np.ascontiguousarray(np.asarray(embeddings)[rows], dtype="float32")
+
+        emb_path = self.path / EMBEDDINGS_FILE
+        if not cached_keys or not emb_path.is_file() or not self._append_rows(emb_path, len(cached_keys),
+                                                                             new_embeddings):
+            # 沒有可追加的檔案（或格式對不上）時才整個重寫
+            existing = self.lookup(cached_keys)
+            if len(existing) != len(cached_keys):
+                cached_keys, existing = [], {}
+            rows_data = [existing[key] for key in cached_keys] + list(new_embeddings)
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp_emb = self.path / (EMBEDDINGS_FILE + ".tmp")
+            with open(tmp_emb, "wb") as f:
+                np.save(f, np.asarray(rows_data, dtype="float32"))
+            os.replace(tmp_emb, emb_path)
+
+        manifest_path = self.path / MANIFEST_FILE
+        manifest = {"settings": self.settings, "index": None, "keys": []}
+        if manifest_path.is_file():
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        manifest["keys"] = cached_keys + new_keys
+        tmp_manifest = self.path / (MANIFEST_FILE + ".tmp")
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_manifest, manifest_path)
+
+    @staticmethod
+    def _append_rows(emb_path: Path, n_rows: int, new_embeddings: np.ndarray) -> bool:
+        # 直接改寫 .npy header 的 shape 並在檔尾寫入新 row；header 長度變了就回傳 False 改走整檔重寫
+        with open(emb_path, "r+b") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                return False
+            data_offset = f.tell()
+            if fortran_order or dtype != np.float32 or shape != (n_rows, new_embeddings.shape[1]):
+                return False
+
+            header = io.BytesIO()
+            header_data = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                           "shape": (n_rows + new_embeddings.shape[0], shape[1])}
+            if version == (1, 0):
+                np.lib.format.write_array_header_1_0(header, header_data)
+            else:
+                np.lib.format.write_array_header_2_0(header, header_data)
+            if header.tell() != data_offset:
+                return False
+
+            # 先寫資料再改 header：中途失敗時 header 仍是舊的 shape，多出來的尾端資料不會被讀到
+            f.seek(data_offset + n_rows * shape[1] * dtype.itemsize)
+            f.write(new_embeddings.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header.getvalue())
+        return True
+
+
+# =========================
+# Query memoisation (LRU)
+# =========================
+class LRUCache:
+
+    def __init__(self, name: str, maxsize: int = RAG_MEMO_SIZE, use_disk: bool = USE_RAG_MEMO_DISK,
+                 cache_dir: Path = RAG_CACHE_DIR):
+        self.name = name
+        self.maxsize = maxsize
+        self.disk_path = Path(cache_dir) / "memo" / name if use_disk else None
+        self._data: OrderedDict[str, Any] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_file(self, key: str) -> Path:
+        return self.disk_path / (text_hash(key) + ".pkl")
+
+    def get(self, key: str) -> Any | None:
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+        if self.disk_path is not None and self._disk_file(key).is_file():
+            with open(self._disk_file(key), "rb") as f:
+                value = pickle.load(f)
+            self._put_memory(key, value)
+            self.disk_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def _put_memory(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key: str, value: Any) -> None:
+        self._put_memory(key, value)
+        if self.disk_path is not None:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+            tmp_file = self._disk_file(key).with_suffix(".tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp_file, self._disk_file(key))
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }